@@ -0,0 +1,49 @@
+"""
+Stress checks subscription churn on a PeerReceiver: many subscribe/cancel
+cycles next to a long lived subscriber must not leak index entries or ZMQ
+filters, and must not disturb delivery.
+
+    python -m benchmarks.churn [cycles]
+"""
+import sys
+import time
+
+import msgpack
+from gevent_zeromq import zmq
+
+from gtutorial.messaging.backend import MessageBackend
+
+CHANNELS = ['/numbers', '/numbers/*', '/numbers/+/avg', '/announce']
+
+def main(cycles=100000):
+    backend = MessageBackend(zmq_=zmq.Context())
+    receiver = backend.receiver
+    resident = backend.subscribe('/numbers')
+
+    start = time.time()
+    for cycle in xrange(cycles):
+        subscription = backend.subscribe(CHANNELS[cycle % len(CHANNELS)])
+        if cycle % 1000 == 0:
+            receiver._dispatch('/numbers', msgpack.packb(cycle))
+            assert resident.get_nowait().value == cycle
+            if subscription.channel == '/numbers':
+                assert subscription.get_nowait().value == cycle
+        subscription.cancel()
+    elapsed = time.time() - start
+
+    receiver._dispatch('/numbers', msgpack.packb('last'))
+    assert resident.get_nowait().value == 'last'
+    assert resident.empty()
+    assert len(receiver.subscriptions) == 1, len(receiver.subscriptions)
+    assert dict(receiver.filters) == {'/numbers\0': 1}, receiver.filters
+
+    resident.cancel()
+    assert len(receiver.subscriptions) == 0
+    assert not receiver.filters
+    assert not receiver.subscriptions.match('/numbers')
+
+    print "{} subscribe/cancel cycles in {:.2f}s ({:.1f}us per cycle), " \
+        "no leaks".format(cycles, elapsed, elapsed * 1e6 / cycles)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,50 @@
+"""
+Boots a cluster_ cluster of simulated nodes on a virtual clock, then
+isolates the leader. Reports virtual time for the roster to converge, for
+the followers to elect a new leader and converge on it, and messages sent
+per node.
+
+    python -m benchmarks.cluster_sim [nodes] [latency_ms] [loss_pct] [seed]
+"""
+import sys
+import time
+
+from gtutorial.cluster_ import ClusterCoordinator
+from gtutorial.simulation import Simulation
+
+def main(nodes=100, latency_ms=1, loss_pct=0, seed=0):
+    hosts = ['10.0.{}.{}'.format(n // 250, n % 250 + 1) for n in xrange(nodes)]
+    leader = hosts[0]
+    started = time.time()
+    with Simulation(latency=latency_ms / 1000.0, jitter=latency_ms / 2000.0,
+                            loss=loss_pct / 100.0, seed=seed) as sim:
+        coordinators = {}
+        for host in hosts:
+            coordinators[host] = ClusterCoordinator(host, leader,
+                                                    zmq_=sim.context(host))
+            sim.start(host, coordinators[host])
+            if host == leader:
+                sim.run(0)
+
+        everyone = set(hosts)
+        def converged(members, expected):
+            return all(set(coordinators[host]._cluster) == expected
+                                                for host in members)
+
+        took = sim.run_until(lambda: converged(hosts, everyone), 600)
+        print "converged {} nodes in {} virtual secs".format(nodes, took)
+        print "messages per node: {:.1f}".format(sim.messages_per_node())
+
+        sim.network.isolate(leader)
+        survivors = hosts[1:]
+        successor = min(survivors)
+        took = sim.run_until(lambda: all(coordinators[host]._leader ==
+                        successor for host in survivors), 600)
+        print "elected {} in {} virtual secs".format(successor, took)
+        took = sim.run_until(lambda: converged(survivors, set(survivors)), 600)
+        print "reconverged in {} more virtual secs".format(took)
+        print "messages per node: {:.1f}".format(sim.messages_per_node())
+    print "wall time {:.1f} secs".format(time.time() - started)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,54 @@
+"""
+Measures the cost of fanning a single backend frame out to N local
+subscriptions, comparing decode-per-subscriber against decode-once.
+
+    python -m benchmarks.fanout [rounds]
+"""
+import sys
+import time
+
+import msgpack
+from gevent_zeromq import zmq
+
+from gtutorial.messaging.backend import MessageBackend
+
+SUBSCRIBER_COUNTS = [1, 100, 1000, 10000]
+PAYLOAD = msgpack.packb('x' * 64)
+
+def drain(subscriptions):
+    for subscription in subscriptions:
+        while not subscription.empty():
+            subscription.get_nowait()
+
+def decode_per_subscriber(receiver, channel, raw):
+    for subscription in receiver.subscriptions.match(channel):
+        subscription.put(msgpack.unpackb(raw))
+
+def decode_once(receiver, channel, raw):
+    receiver._dispatch(channel, raw)
+
+def measure(dispatch, receiver, subscriptions, rounds):
+    elapsed = 0.0
+    for _ in xrange(rounds):
+        start = time.time()
+        dispatch(receiver, '/numbers', PAYLOAD)
+        elapsed += time.time() - start
+        drain(subscriptions)
+    return elapsed / rounds
+
+def main(rounds=20):
+    for count in SUBSCRIBER_COUNTS:
+        backend = MessageBackend(zmq_=zmq.Context())
+        subscriptions = [backend.subscribe('/numbers') for _ in xrange(count)]
+        before = measure(decode_per_subscriber, backend.receiver,
+                                                subscriptions, rounds)
+        after = measure(decode_once, backend.receiver, subscriptions, rounds)
+        print "{:>6} subscribers: {:>10.1f}us -> {:>10.1f}us per frame " \
+            "({:.2f}us -> {:.2f}us per delivery)".format(count,
+                before * 1e6, after * 1e6,
+                before * 1e6 / count, after * 1e6 / count)
+        for subscription in subscriptions:
+            subscription.cancel()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
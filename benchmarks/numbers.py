@@ -0,0 +1,76 @@
+"""
+Runs a high rate NumberServer over loopback in line and in binary mode and
+counts the numbers a raw client receives. Reports bytes on the wire and
+process CPU time per number for each mode.
+
+    python -m benchmarks.numbers [rate_per_sec] [seconds]
+"""
+import sys
+import time
+import struct
+
+import gevent
+from gevent.socket import create_connection
+
+from ginkgo import settings
+
+from gtutorial.numbers import NumberServer, BINARY_HELLO
+
+PORT = 7799
+
+def count_lines(data, pending):
+    return data.count('\n'), ''
+
+def count_frames(data, pending):
+    data = pending + data
+    numbers, offset = 0, 0
+    while len(data) - offset >= 4:
+        count, = struct.unpack_from('!I', data, offset)
+        if len(data) < offset + 4 + count:
+            break
+        numbers += count
+        offset += 4 + count
+    return numbers, data[offset:]
+
+def run(rate, seconds, binary):
+    settings.set('numbers_bind', ('127.0.0.1', PORT))
+    settings.set('numbers_high_rate', True)
+    settings.set('numbers_binary', binary)
+    settings.set('rate_per_minute', rate * 60)
+    server = NumberServer()
+    server.start()
+
+    received = [0, 0] # numbers, bytes
+    def consume():
+        client = create_connection(('127.0.0.1', PORT))
+        count, pending = count_lines, ''
+        if binary:
+            client.sendall(BINARY_HELLO)
+            client.recv(len(BINARY_HELLO))
+            count = count_frames
+        while True:
+            data = client.recv(65536)
+            numbers, pending = count(data, pending)
+            received[0] += numbers
+            received[1] += len(data)
+    consumer = gevent.spawn(consume)
+
+    cpu, start = time.clock(), time.time()
+    gevent.sleep(seconds)
+    cpu, elapsed = time.clock() - cpu, time.time() - start
+    consumer.kill()
+    server.stop()
+    return received[0], received[1], elapsed, cpu
+
+def main(rate=1000000, seconds=5):
+    print "{:>8} {:>12} {:>12} {:>10} {:>12}".format(
+        'mode', 'target/sec', 'numbers/sec', 'bytes/num', 'cpu us/num')
+    for binary in (False, True):
+        numbers, bytes_, elapsed, cpu = run(rate, seconds, binary)
+        print "{:>8} {:>12} {:>12.0f} {:>10.2f} {:>12.3f}".format(
+            'binary' if binary else 'line', rate, numbers / elapsed,
+            float(bytes_) / max(1, numbers),
+            cpu * 1000000 / max(1, numbers))
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
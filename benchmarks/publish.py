@@ -0,0 +1,69 @@
+"""
+Compares publish throughput and latency with and without batching, over a
+loopback MessageBackend publishing to itself.
+
+    python -m benchmarks.publish [messages]
+"""
+import sys
+import time
+
+import gevent
+from gevent_zeromq import zmq
+
+from ginkgo import settings
+
+from gtutorial.messaging.backend import MessageBackend
+from gtutorial.util import ObservableSet
+
+MESSAGE_SIZES = [16, 256, 4096]
+BATCH_SIZES = [0, 16, 128]
+PORT = 2299
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(messages, size, batch_size):
+    settings.set('backend_port', PORT)
+    settings.set('backend_batch_size', batch_size)
+    settings.set('subscription_queue_size', messages)
+    backend = MessageBackend(ObservableSet(['127.0.0.1']), '127.0.0.1',
+                                                        zmq.Context())
+    backend.start()
+    subscription = backend.subscribe('/bench')
+    gevent.sleep(0.5) # let the SUB filter reach the publisher
+
+    latencies = []
+    def consume():
+        for message in subscription:
+            latencies.append(time.time() - message.value[0])
+            if len(latencies) == messages:
+                break
+    consumer = gevent.spawn(consume)
+
+    body = 'x' * size
+    start = time.time()
+    for count in xrange(messages):
+        backend.publish('/bench', (time.time(), body))
+        if count % 100 == 0:
+            gevent.sleep(0)
+    consumer.join(timeout=30)
+    elapsed = time.time() - start
+
+    subscription.cancel()
+    backend.stop()
+    latencies.sort()
+    return len(latencies) / elapsed, latencies
+
+def main(messages=100000):
+    print "{:>6} {:>6} {:>12} {:>10} {:>10}".format(
+        'size', 'batch', 'msgs/sec', 'p50 ms', 'p99 ms')
+    for size in MESSAGE_SIZES:
+        for batch_size in BATCH_SIZES:
+            rate, latencies = run(messages, size, batch_size)
+            print "{:>6} {:>6} {:>12.0f} {:>10.3f} {:>10.3f}".format(
+                size, batch_size or '-', rate,
+                percentile(latencies, 0.5) * 1000,
+                percentile(latencies, 0.99) * 1000)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
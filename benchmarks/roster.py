@@ -0,0 +1,127 @@
+"""
+Simulates a 500 node cluster joining and then doing a rolling restart
+against the cluster.py leader, with followers applying roster messages in
+process. Reports bytes on the wire for full roster broadcasts versus
+numbered deltas, and how long followers take to converge.
+
+The same join and restart is then run against a cluster_ leader on the
+simulated network, reporting what the leader sends. Restarted followers
+ask the leader's greeter for the roster, so only they are sent it.
+
+    python -m benchmarks.roster [nodes]
+"""
+import sys
+import time
+import json
+
+from gtutorial import cluster_
+from gtutorial.cluster import ClusterCoordinator, PeerClient
+from gtutorial.simulation import Simulation
+
+class Follower(object):
+    """Stands in for a follower's socket on the leader"""
+    def __init__(self, coordinator, host):
+        self.server = coordinator.server
+        self.client = PeerClient(coordinator, '10.0.0.0', host)
+        self.bytes = 0
+
+    def send(self, data):
+        self.bytes += len(data)
+        if not self.client._apply(json.loads(data)):
+            self.send(self.server._cluster_message())
+
+def full_roster_bytes(server):
+    # What the old protocol sent on every change
+    message = '%s\n' % json.dumps({'cluster': list(server.c.set)})
+    return len(message) * len(server.clients)
+
+def simulated(hosts):
+    leader, followers = hosts[0], hosts[1:]
+    everyone = set(hosts)
+    with Simulation() as sim:
+        coordinators = {}
+
+        def start(host):
+            coordinators[host] = cluster_.ClusterCoordinator(host, leader,
+                                                    zmq_=sim.context(host))
+            sim.start(host, coordinators[host])
+
+        def stop(host):
+            coordinators[host].stop()
+            for socket in sim.network.sockets:
+                if socket.host == host:
+                    socket.close()
+            sim.network.sockets = [socket for socket in sim.network.sockets
+                                                    if not socket.closed]
+
+        def converged(host):
+            return set(coordinators[host]._cluster) == everyone
+
+        start(leader)
+        sim.run(0)
+        for host in followers:
+            start(host)
+        took = sim.run_until(lambda: all(converged(host) for host in hosts),
+                                                                        600)
+        joined = sim.network.bytes[leader]
+
+        restarted = time.time()
+        for host in followers:
+            stop(host)
+            start(host)
+            sim.run_until(lambda: converged(host), 600)
+        elapsed = time.time() - restarted
+        restart = sim.network.bytes[leader] - joined
+        snapshot = sum(len(frame) for frame in
+                            coordinators[leader]._server._snapshot())
+
+    print "cluster_ leader, simulated"
+    print "joined in {} virtual secs, {:,} bytes".format(took, joined)
+    print "restart:     {:>14,} bytes ({:,} per follower)".format(restart,
+                                                restart / len(followers))
+    print "broadcast snapshots would add {:,} bytes".format(
+                        snapshot * (len(hosts) - 2) * len(followers))
+    print "restarted in {:.1f}s wall time".format(elapsed)
+
+def main(nodes=500):
+    coordinator = ClusterCoordinator('10.0.0.0')
+    server = coordinator.server
+    coordinator.set.add('10.0.0.0')
+    hosts = ['10.0.{}.{}'.format(n // 250, n % 250 + 1) for n in xrange(nodes)]
+    followers = dict((host, Follower(coordinator, host)) for host in hosts)
+    full = [0]
+
+    def join(host):
+        snapshot = server._cluster_message()
+        followers[host].send(snapshot)
+        full[0] += len(snapshot)
+        server._update(add={'host': host, 'socket': followers[host]})
+        full[0] += full_roster_bytes(server)
+
+    def leave(host):
+        server._update(remove=host)
+        full[0] += full_roster_bytes(server)
+
+    start = time.time()
+    for host in hosts:
+        join(host)
+    for host in hosts:
+        leave(host)
+        join(host)
+    elapsed = time.time() - start
+
+    roster = set(coordinator.set)
+    assert all(f.client.roster == roster for f in followers.values())
+    delta = sum(f.bytes for f in followers.values())
+    changes = server.epoch
+    print "{} nodes, {} roster changes".format(nodes, changes)
+    print "full roster: {:>14,} bytes".format(full[0])
+    print "deltas:      {:>14,} bytes ({:.1f}x less)".format(delta,
+                                                float(full[0]) / delta)
+    print "converged in {:.3f}s ({:.1f}us per change)".format(elapsed,
+                                                elapsed * 1e6 / changes)
+    print
+    simulated(hosts)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,228 @@
+"""
+Boots the whole stack on loopback: a high rate NumberServer, a cluster of
+NumberGateways on 127.0.0.1, 127.0.0.2, ... and processes full of HTTP
+stream, tail view and WebSocket subscribers spread over the gateways. A
+publisher then sends timestamped messages on /bench for every combination
+of publish rate, message size and subscriber count.
+
+Each run prints one JSON object per line with delivered throughput,
+p50/p99/p999 latency from publish to subscriber socket, and the gateways'
+RSS and CPU time, so results from two commits can be diffed directly.
+Progress goes to stderr.
+
+    python -m benchmarks.suite [seconds] [gateways] > results.jsonl
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import signal
+import base64
+import itertools
+import subprocess
+import multiprocessing
+
+import gevent
+import gevent.socket
+from gevent_zeromq import zmq
+
+from ginkgo import settings
+
+from gtutorial.messaging.backend import MessageBackend
+from gtutorial.util import ObservableSet
+
+RATES = [1000, 10000]
+SIZES = [16, 1024]
+SUBSCRIBERS = [100, 1000]
+KINDS = ['stream', 'tail', 'websocket']
+CLIENT_PROCESSES = 4
+NUMBERS_RATE = 10000
+LATENCY_SAMPLES = 100000
+
+PORTS = {'stream': 8088, 'tail': 8089, 'websocket': 7070}
+NUMBERS_PORT = 7776
+
+# Every subscriber writes str() of the published [timestamp, body] array
+TIMESTAMP = re.compile(r"\[(\d+\.\d+), ")
+
+GATEWAY_PIDS = []
+
+def gateway_identity(index):
+    return '127.0.0.{}'.format(index + 1)
+
+def numbers_process():
+    from gtutorial.numbers import NumberServer
+    random.seed(0)
+    settings.set('numbers_bind', ('127.0.0.1', NUMBERS_PORT))
+    settings.set('numbers_high_rate', True)
+    settings.set('rate_per_minute', NUMBERS_RATE * 60)
+    server = NumberServer()
+    gevent.signal(signal.SIGTERM, server.stop)
+    server.serve_forever()
+
+def gateway_process(index):
+    from gtutorial.gateway import NumberGateway
+    settings.set('identity', gateway_identity(index))
+    settings.set('leader', gateway_identity(0))
+    settings.set('subscription_queue_size', 1024)
+    gateway = NumberGateway()
+    gevent.signal(signal.SIGTERM, gateway.stop)
+    gateway.serve_forever()
+
+def request(kind):
+    if kind != 'websocket':
+        return 'GET /bench HTTP/1.1\r\nHost: bench\r\n\r\n'
+    key = base64.b64encode(os.urandom(16))
+    return ('GET /bench HTTP/1.1\r\nHost: bench\r\nUpgrade: websocket\r\n'
+            'Connection: Upgrade\r\nSec-WebSocket-Key: {}\r\n'
+            'Sec-WebSocket-Version: 13\r\n\r\n'.format(key))
+
+def subscriber_process(subscribers, warmup, seconds, results):
+    counting = [False]
+    received = [0]
+    latencies = []
+
+    def subscribe(kind, host):
+        sock = gevent.socket.create_connection((host, PORTS[kind]))
+        sock.sendall(request(kind))
+        pending = ''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            now = time.time()
+            pending += data
+            end = 0
+            for match in TIMESTAMP.finditer(pending):
+                end = match.end()
+                if counting[0]:
+                    received[0] += 1
+                    if len(latencies) < LATENCY_SAMPLES:
+                        latencies.append(now - float(match.group(1)))
+            pending = pending[end:][-256:]
+
+    greenlets = [gevent.spawn(subscribe, kind, host)
+                                for kind, host in subscribers]
+    gevent.sleep(warmup)
+    counting[0] = True
+    gevent.sleep(seconds)
+    counting[0] = False
+    results.put((received[0], latencies))
+    gevent.killall(greenlets)
+
+def usage(pid):
+    """Returns (RSS in KB, CPU seconds) of a process from /proc, if any"""
+    try:
+        with open('/proc/{}/status'.format(pid)) as status:
+            rss = int(re.search(r'VmRSS:\s+(\d+)', status.read()).group(1))
+        with open('/proc/{}/stat'.format(pid)) as stat:
+            fields = stat.read().rsplit(')', 1)[1].split()
+        ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+        return rss, (int(fields[11]) + int(fields[12])) / float(ticks)
+    except (IOError, OSError, AttributeError, KeyError):
+        return None, None
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run(publisher, gateways, rate, size, subscribers, seconds):
+    kinds = itertools.cycle(itertools.product(KINDS,
+                        [gateway_identity(i) for i in xrange(gateways)]))
+    everyone = [next(kinds) for _ in xrange(subscribers)]
+    warmup = 2
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=subscriber_process,
+            args=(everyone[i::CLIENT_PROCESSES], warmup, seconds, results))
+                                    for i in xrange(CLIENT_PROCESSES)]
+    for client in clients:
+        client.start()
+
+    body = 'x' * size
+    before = [usage(pid) for pid in GATEWAY_PIDS]
+    started = time.time()
+    deadline = started + warmup + seconds + 1
+    sent = 0
+    while time.time() < deadline:
+        due = int((time.time() - started) * rate) - sent
+        for _ in xrange(due):
+            publisher.publish('/bench', (time.time(), body))
+        sent += due
+        gevent.sleep(0.001)
+    after = [usage(pid) for pid in GATEWAY_PIDS]
+    elapsed = time.time() - started
+
+    delivered, latencies = 0, []
+    for _ in clients:
+        count, samples = results.get()
+        delivered += count
+        latencies.extend(samples)
+    for client in clients:
+        client.join()
+    latencies.sort()
+
+    rss = [end[0] for end in after if end[0] is not None]
+    cpu = [end[1] - start[1] for start, end in zip(before, after)
+                                    if None not in (start[1], end[1])]
+    return {
+        'gateways': gateways,
+        'rate': rate,
+        'size': size,
+        'subscribers': subscribers,
+        'delivered_per_sec': round(delivered / float(seconds), 1),
+        'expected_per_sec': rate * subscribers,
+        'p50_ms': ms(percentile(latencies, 0.5)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'p999_ms': ms(percentile(latencies, 0.999)),
+        'gateway_rss_kb': max(rss) if rss else None,
+        'gateway_cpu_pct': round(100 * sum(cpu) / elapsed, 1)
+                                                    if cpu else None,
+    }
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                            'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(seconds=10, gateways=2):
+    numbers = multiprocessing.Process(target=numbers_process)
+    numbers.start()
+    processes = [numbers]
+    for index in xrange(gateways):
+        gateway = multiprocessing.Process(target=gateway_process,
+                                                    args=(index,))
+        gateway.start()
+        processes.append(gateway)
+        GATEWAY_PIDS.append(gateway.pid)
+        time.sleep(1) # the leader has to be up before followers join
+    time.sleep(2)
+
+    publisher = MessageBackend(ObservableSet(gateway_identity(i)
+                    for i in xrange(gateways)), '127.0.0.1', zmq.Context())
+    publisher.transmitter.start()
+    revision = commit()
+    try:
+        for rate, size, subscribers in itertools.product(RATES, SIZES,
+                                                        SUBSCRIBERS):
+            sys.stderr.write("rate {} size {} subscribers {}\n".format(
+                                                rate, size, subscribers))
+            result = run(publisher, gateways, rate, size, subscribers,
+                                                                seconds)
+            result['commit'] = revision
+            print json.dumps(result, sort_keys=True)
+            sys.stdout.flush()
+    finally:
+        for process in processes:
+            os.kill(process.pid, signal.SIGTERM)
+            process.join()
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,53 @@
+"""
+Compares building multipart frames for tail viewers per viewer, as
+HttpTailViewer used to, against framing each message once and sharing it.
+Reports CPU time and bytes of frames allocated per delivered message.
+
+    python -m benchmarks.tailview [messages] [viewers]
+"""
+import sys
+import time
+import random
+
+import msgpack
+
+from gtutorial.messaging.backend import Message
+from gtutorial.messaging.http import MultipartFramer
+
+def per_viewer(messages, viewers):
+    boundaries = [str(random.random()) for _ in xrange(viewers)]
+    for msg in messages:
+        for boundary in boundaries:
+            yield '\n'.join([
+                'Content-Type: text/plain',
+                'Content-Length: {}'.format(len(msg)),
+                '\n{}'.format(msg),
+                '--{}\n'.format(boundary)])
+
+def shared(messages, viewers):
+    framer = MultipartFramer('bench')
+    for msg in messages:
+        for _ in xrange(viewers):
+            yield msg.render(framer.frame)
+
+def measure(write_path, messages, viewers):
+    frames = {}
+    start = time.clock()
+    for frame in write_path(messages, viewers):
+        frames[id(frame)] = frame
+    cpu = time.clock() - start
+    allocated = sum(len(frame) for frame in frames.values())
+    return cpu, allocated
+
+def main(messages=1000, viewers=100):
+    for name, write_path in [('per viewer', per_viewer), ('shared', shared)]:
+        batch = [Message('/numbers', msgpack.packb(str(n) * 8))
+                            for n in xrange(messages)]
+        cpu, allocated = measure(write_path, batch, viewers)
+        deliveries = messages * viewers
+        print "{:>10}: {:.2f}us CPU, {:.1f} frame bytes allocated " \
+            "per delivered message".format(name, cpu * 1e6 / deliveries,
+                                        float(allocated) / deliveries)
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
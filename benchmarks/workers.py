@@ -0,0 +1,96 @@
+"""
+Measures messages per second delivered to HTTP stream subscribers by a
+MessageHub as hub_workers grows. The hub runs in its own process tree and
+subscribers are spread over several client processes so they don't become
+the bottleneck.
+
+    python -m benchmarks.workers [subscribers] [seconds] [max_workers]
+"""
+import os
+import sys
+import time
+import signal
+import multiprocessing
+
+import gevent
+import gevent.socket
+from gevent_zeromq import zmq
+
+from ginkgo import settings
+
+from gtutorial.messaging.backend import MessageBackend
+from gtutorial.util import ObservableSet
+
+BACKEND_PORT = 2298
+STREAM_PORT = 8098
+CLIENT_PROCESSES = 4
+PUBLISH_RATE = 2000
+
+def subscriber_process(subscribers, seconds, results):
+    received = [0]
+    def stream():
+        sock = gevent.socket.create_connection(('127.0.0.1', STREAM_PORT))
+        sock.sendall('GET /bench HTTP/1.1\r\nHost: bench\r\n\r\n')
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            received[0] += data.count('\n')
+    greenlets = [gevent.spawn(stream) for _ in xrange(subscribers)]
+    gevent.sleep(1) # let subscriptions settle before counting
+    start = received[0]
+    gevent.sleep(seconds)
+    results.put(received[0] - start)
+    gevent.killall(greenlets)
+
+def hub_process():
+    from gtutorial.messaging.hub import MessageHub
+    hub = MessageHub(ObservableSet(['127.0.0.1']), '127.0.0.1')
+    # Stopping the hub also terminates its workers
+    gevent.signal(signal.SIGTERM, hub.stop)
+    hub.serve_forever()
+
+def run(workers, subscribers, seconds):
+    settings.set('hub_workers', workers)
+    settings.set('backend_port', BACKEND_PORT)
+    settings.set('pubsub_port', STREAM_PORT)
+    settings.set('subscription_queue_size', 1024)
+    hub = multiprocessing.Process(target=hub_process)
+    hub.start()
+    time.sleep(1)
+
+    results = multiprocessing.Queue()
+    clients = [multiprocessing.Process(target=subscriber_process,
+            args=(subscribers // CLIENT_PROCESSES, seconds, results))
+                                for _ in xrange(CLIENT_PROCESSES)]
+    for client in clients:
+        client.start()
+
+    publisher = MessageBackend(ObservableSet(['127.0.0.1']),
+                                        '127.0.0.1', zmq.Context())
+    publisher.transmitter.start()
+    deadline = time.time() + seconds + 2
+    while time.time() < deadline:
+        for _ in xrange(PUBLISH_RATE // 100):
+            publisher.publish('/bench', 'x' * 32)
+        gevent.sleep(0.01)
+
+    delivered = sum(results.get() for _ in clients)
+    for client in clients:
+        client.join()
+    os.kill(hub.pid, signal.SIGTERM)
+    hub.join()
+    return delivered / float(seconds)
+
+def main(subscribers=1000, seconds=10, max_workers=multiprocessing.cpu_count()):
+    baseline = None
+    workers = 1
+    while workers <= max_workers:
+        rate = run(workers, subscribers, seconds)
+        baseline = baseline or rate
+        print "{:>3} workers: {:>12.0f} msgs/sec delivered ({:.2f}x)".format(
+                                            workers, rate, rate / baseline)
+        workers *= 2
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -13,8 +13,11 @@ from ginkgo import Setting
 from ginkgo import util
 
 from .util import ObservableSet
+from .liveness import failure_detector
+from .timers import TimerWheel
 
 CLIENT_TIMEOUT_SECONDS = 10
+CLIENT_CHECK_SECONDS = 1
 SERVER_KEEPALIVE_SECONDS = 5
 
 logger = logging.getLogger(__name__)
@@ -24,9 +27,19 @@ class NewLeader(Exception): pass
 
 class ClusterCoordinator(Service):
     port = Setting('cluster_port', default=4440)
+    detector = Setting('cluster_failure_detector', default='phi', help="""\
+        How clients are judged dead: phi (phi accrual over the keepalive
+        history) or fixed (no keepalive for CLIENT_TIMEOUT_SECONDS)
+        """)
+    phi_threshold = Setting('cluster_phi_threshold', default=8.0,
+        help="Phi at which a client is suspected with the phi detector")
 
-    def __init__(self, identity, leader=None, cluster=None):
+    def __init__(self, identity, leader=None, cluster=None, timers=None):
         leader = leader or identity
+        if timers is None:
+            timers = TimerWheel()
+            self.add_service(timers)
+        self.timers = timers
         self.server = PeerServer(self, identity)
         self.client = PeerClient(self, leader, identity)
         self.set = cluster or ObservableSet()
@@ -42,6 +55,10 @@ class ClusterCoordinator(Service):
     def wait_for_promotion(self):
         self.promoted.wait()
 
+    def suspicion(self):
+        """Current suspicion score per client, failed at 1 for fixed"""
+        return self.server.detector.suspicions()
+
     @property
     def leader(self):
         return self.client.leader
@@ -55,6 +72,10 @@ class PeerServer(Service):
         self.c = coordinator
         self.identity = identity
         self.clients = {}
+        self.detector = failure_detector(self.c.detector,
+                            SERVER_KEEPALIVE_SECONDS, CLIENT_TIMEOUT_SECONDS,
+                            self.c.phi_threshold)
+        self.epoch = 0
         self.server = gevent.server.StreamServer((identity, self.c.port), 
                         handle=self.handle, spawn=self.spawn)
 
@@ -71,6 +92,10 @@ class PeerServer(Service):
         to the cluster roster, broadcast to all nodes the new roster, and wait
         for keepalives. If no keepalive within timeout or the client drops, it
         drops it from the roster and broadcasts to all remaining nodes. 
+
+        A joining client gets the full roster, after that only numbered
+        changes are broadcast. A client that misses one asks for the full
+        roster again by sending "snapshot".
         """
         if not self.c.is_leader:
             socket.send(json.dumps({'leader': self.c.client.leader, 
@@ -90,39 +115,57 @@ class PeerServer(Service):
             logger.debug('New connection from %s' % name)
             self._update(add={'host': name, 'socket': socket})
             # TODO: Use TCP keepalives
-            timeout = self._client_timeout(socket)
+            self._client_timeout(name, socket)
             for line in util.line_protocol(sockfile, strip=False):
-                timeout.kill()
-                timeout = self._client_timeout(socket)
-                socket.send('\n')
+                self.detector.heartbeat(name)
+                if line.strip() == 'snapshot':
+                    socket.send(self._cluster_message())
+                else:
+                    socket.send('\n')
                 #logger.debug("Keepalive from %s:%s" % address)
             #logger.debug("Client disconnected from %s:%s" % address)
             self._update(remove=name)
 
-    def _client_timeout(self, socket):
-        def shutdown(socket):
+    def _client_timeout(self, name, socket):
+        """ Shuts down the client's socket once it stops sending keepalives """
+        def check():
+            if self.clients.get(name) is not socket:
+                return
+            if self.detector.is_available(name):
+                self.c.timers.schedule(CLIENT_CHECK_SECONDS, check)
+                return
             try:
                 socket.shutdown(0)
             except IOError:
                 pass
-        return self.spawn_later(CLIENT_TIMEOUT_SECONDS, 
-                lambda: shutdown(socket))
+        # A reconnecting client starts with a fresh history
+        self.detector.remove(name)
+        self.detector.heartbeat(name)
+        self.c.timers.schedule(CLIENT_CHECK_SECONDS, check)
 
     def _cluster_message(self):
-        return '%s\n' % json.dumps({'cluster': list(self.c.set)})
+        return '%s\n' % json.dumps({'cluster': list(self.c.set),
+                                    'epoch': self.epoch})
 
     def _update(self, add=None, remove=None):
-        """ Used by leader to manage and broadcast roster """
+        """ Used by leader to manage and broadcast roster changes """
+        delta = {}
         if add is not None:
             self.c.set.add(add['host'])
             self.clients[add['host']] = add['socket']
+            delta['add'] = [add['host']]
             #logger.debug("Added to cluster: %s" % add['host'])
         if remove is not None:
             self.c.set.remove(remove)
             del self.clients[remove]
+            self.detector.remove(remove)
+            delta['remove'] = [remove]
             #logger.debug("Removed from cluster: %s" % remove)
+        self.epoch += 1
+        delta['epoch'] = self.epoch
+        message = '%s\n' % json.dumps(delta)
         for client in self.clients:
-            self.clients[client].send(self._cluster_message())
+            self.clients[client].send(message)
 
 
 class PeerClient(Service):
@@ -130,6 +173,9 @@ class PeerClient(Service):
         self.c = coordinator
         self.leader = leader
         self.identity = identity
+        self.roster = set()
+        self.epoch = None
+        self.resyncing = False
 
     def do_start(self):
         self.spawn(self.connect)
@@ -151,13 +197,15 @@ class PeerClient(Service):
         #logger.debug("Connected to leader")
         client_address = self.identity or socket.getsockname()[0]
         socket.send('%s\n' % client_address)
+        self.epoch = None
+        self.resyncing = False
         # TODO: Use TCP keepalives
         keepalive = self._server_keepalive(socket)
         try:
             for line in util.line_protocol(socket, strip=False):
                 if line == '\n':
-                    # Keepalive ack from leader
-                    keepalive.kill()
+                    # Keepalive ack from leader, the next one is due later
+                    keepalive.cancel()
                     keepalive = self._server_keepalive(socket)
                 else:
                     cluster = json.loads(line)
@@ -167,9 +215,11 @@ class PeerClient(Service):
                         logger.info("Redirected to %s:%s..." % 
                                             (self.leader, self.c.port))
                         raise NewLeader()
-                    elif client_address in cluster['cluster']:
+                    elif not self._apply(cluster):
+                        socket.send('snapshot\n')
+                    elif client_address in self.roster:
                         # Only report cluster once I'm a member
-                        self.c.set.replace(set(cluster['cluster']))
+                        self.c.set.replace(set(self.roster))
             self.c.set.remove(self.leader)
             self._leader_election()
         except NewLeader:
@@ -180,15 +230,34 @@ class PeerClient(Service):
                 self.stop() # doesn't work
             else:
                 return
+        finally:
+            keepalive.cancel()
+
+    def _apply(self, message):
+        """
+        Applies a full roster or a change to the local copy. Returns False
+        when a change was missed and the full roster has to be requested.
+        """
+        if 'cluster' in message:
+            self.roster = set(message['cluster'])
+            self.epoch = message['epoch']
+            self.resyncing = False
+        elif self.epoch is None or message['epoch'] > self.epoch + 1:
+            if not self.resyncing:
+                self.resyncing = True
+                return False
+        elif message['epoch'] == self.epoch + 1:
+            self.roster.update(message.get('add', []))
+            self.roster.difference_update(message.get('remove', []))
+            self.epoch = message['epoch']
+        return True
 
     def _server_keepalive(self, socket):
-        return self.spawn_later(SERVER_KEEPALIVE_SECONDS, 
-            lambda: socket.send('\n'))
+        return self.c.timers.schedule(SERVER_KEEPALIVE_SECONDS,
+            socket.send, '\n')
 
     def _leader_election(self):
-        candidates = list(self.c.set)
-        candidates.sort()
-        self.leader = candidates[0]
+        self.leader = min(self.c.set)
         logger.info("New leader %s:%s..." % (self.leader, self.c.port))
         # TODO: if i end up thinking i'm the leader when i'm not
         # then i will not rejoin the cluster
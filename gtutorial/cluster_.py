@@ -1,5 +1,5 @@
 import logging
-import time
+import collections
 
 import gevent
 from gevent import Timeout
@@ -9,7 +9,8 @@ from gevent_zeromq import zmq
 from ginkgo.core import Service, autospawn
 from ginkgo.config import Setting
 
-from .util import ObservableSet
+from .util import ObservableSet, monotonic
+from .liveness import failure_detector
 
 logger = logging.getLogger(__name__)
 
@@ -18,6 +19,12 @@ class ClusterCoordinator(Service):
     heartbeat_port = Setting('cluster_heartbeat_port', default=4441)
     greeter_port = Setting('cluster_greeter_port', default=4442)
     heartbeat_interval = Setting('cluster_heartbeat_interval_secs', default=2)
+    detector = Setting('cluster_failure_detector', default='phi', help="""\
+        How followers are judged dead: phi (phi accrual over the heartbeat
+        history) or fixed (no heartbeat for two intervals)
+        """)
+    phi_threshold = Setting('cluster_phi_threshold', default=8.0,
+        help="Phi at which a follower is suspected with the phi detector")
 
     def __init__(self, identity, leader=None, cluster=None, zmq_=None):
         self._zmq = zmq_ or zmq.Context()
@@ -30,6 +37,12 @@ class ClusterCoordinator(Service):
         self._client = PeerClient(self)
 
         self._greeter = self._zmq.socket(zmq.REP)
+        self._scouts = ScoutPool(self._zmq, self.greeter_port)
+
+        def close_scouts(added, removed):
+            for peer in removed:
+                self._scouts.discard(peer)
+        self._cluster.attach_changes(close_scouts)
 
         self.add_service(self._server)
 
@@ -53,8 +66,14 @@ class ClusterCoordinator(Service):
     @autospawn
     def _greet(self):
         while True:
-            self._greeter.recv() # HELLO
-            if self.is_leader:
+            request = self._greeter.recv() # HELLO or SNAPSHOT
+            if request == 'SNAPSHOT':
+                # Only the follower that asked gets the whole roster
+                if self.is_leader:
+                    self._greeter.send_multipart(self._server._snapshot())
+                else:
+                    self._greeter.send_multipart(['REDIRECT', self._leader])
+            elif self.is_leader:
                 self._greeter.send_multipart(['WELCOME', ''])
             else:
                 response = self.scout(self._leader, 1)
@@ -67,21 +86,87 @@ class ClusterCoordinator(Service):
                     self._greeter.send_multipart(['RETRY', ''])
 
     def scout(self, leader, timeout=2):
-        scout = self._zmq.socket(zmq.REQ)
-        scout.connect("tcp://{}:{}".format(leader, self.greeter_port))
-        scout.send('HELLO')
+        return self._scouts.scout(leader, timeout)
+
+    def suspicion(self):
+        """Current suspicion score per follower, failed at 1 for fixed"""
+        return self._server._detector.suspicions()
+
+    def scout_stats(self):
+        """Scout round trip percentiles and timeouts per peer"""
+        return self._scouts.stats()
+
+class ScoutPool(object):
+    """
+    Keeps REQ sockets to peers' greeters open between scouts instead of
+    connecting for every HELLO. A socket that timed out is still waiting
+    for its reply, so it is closed and a new one is connected on next use.
+    Round trip times of recent scouts are kept per peer.
+    """
+    def __init__(self, context, port, samples=128):
+        self._zmq = context
+        self.port = port
+        self.samples = samples
+        self._idle = collections.defaultdict(list)
+        self.rtts = {}
+        self.timeouts = collections.Counter()
+
+    def scout(self, peer, timeout=2):
+        return self.request(peer, 'HELLO', timeout)
+
+    def request(self, peer, message, timeout=2):
+        """Sends a request to a peer's greeter, [] if there's no reply"""
+        idle = self._idle[peer]
+        socket = idle.pop() if idle else self._connect(peer)
+        started = monotonic()
+        socket.send(message)
         response = []
         with Timeout(timeout, False):
-            response = scout.recv_multipart()
-        scout.close()
+            response = socket.recv_multipart()
+        if response:
+            if peer not in self.rtts:
+                self.rtts[peer] = collections.deque(maxlen=self.samples)
+            self.rtts[peer].append(monotonic() - started)
+            idle.append(socket)
+        else:
+            self.timeouts[peer] += 1
+            socket.close()
         return response
 
+    def discard(self, peer):
+        """Closes the idle sockets to a peer and forgets its stats"""
+        for socket in self._idle.pop(peer, []):
+            socket.close()
+        self.rtts.pop(peer, None)
+        self.timeouts.pop(peer, None)
+
+    def percentiles(self, peer, points=(50, 90, 99)):
+        samples = sorted(self.rtts.get(peer, []))
+        if not samples:
+            return {}
+        return dict(('p{}'.format(point),
+            samples[min(len(samples) - 1, len(samples) * point // 100)])
+                                                    for point in points)
+
+    def stats(self):
+        peers = set(self.rtts) | set(self.timeouts)
+        return dict((peer, dict(self.percentiles(peer),
+                        timeouts=self.timeouts[peer])) for peer in peers)
+
+    def _connect(self, peer):
+        socket = self._zmq.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect("tcp://{}:{}".format(peer, self.port))
+        return socket
+
 class PeerClient(Service):
     def __init__(self, coordinator):
         self.c = coordinator
         self._following = Event()
         self._listener = None
         self._heartbeater = None
+        self._epoch = None
+        self._resyncing = False
 
     def do_start(self):
         self._follow_leader()
@@ -105,6 +190,8 @@ class PeerClient(Service):
         self._heartbeater.connect("tcp://{}:{}".format(self.c._leader,
             self.c.heartbeat_port))
 
+        self._epoch = None
+        self._resyncing = False
         self._following.set()
 
     def _confirm_leader(self, leader):
@@ -125,9 +212,8 @@ class PeerClient(Service):
     def _next_leader(self):
         self._following.clear()
         self.c._cluster.remove(self.c._leader)
-        candidates = sorted(list(self.c._cluster))
-        self.c._leader = candidates[0]
-        logger.debug("A new leader is decided: {}".format(candidates[0]))
+        self.c._leader = min(self.c._cluster)
+        logger.debug("A new leader is decided: {}".format(self.c._leader))
         if self.c.is_leader:
             self.c._promoted.set()
         else:
@@ -144,9 +230,44 @@ class PeerClient(Service):
     def _listen_for_updates(self):
         while True:
             self._following.wait()
-            cluster = self._listener.recv_multipart()
-            logger.debug("Got cluster update")
-            self.c._cluster.replace(set(cluster))
+            self._apply(self._listener.recv_multipart())
+
+    def _apply(self, frames):
+        """
+        Applies a roster update from the leader. Changes are numbered, and
+        when one is missed, or the leader is new, the full roster is asked
+        of the leader's greeter. If that fails it is asked again on every
+        epoch heartbeat until the epochs match.
+        """
+        kind, epoch = frames[0], int(frames[1])
+        if self._epoch is not None:
+            if kind == 'delta' and epoch <= self._epoch:
+                return
+            elif kind == 'delta' and epoch == self._epoch + 1:
+                with self.c._cluster.batch():
+                    for change in frames[2:]:
+                        if change[0] == '+':
+                            self.c._cluster.add(change[1:])
+                        else:
+                            self.c._cluster.remove(change[1:])
+                self._epoch = epoch
+                return
+            elif kind == 'epoch' and epoch == self._epoch:
+                return
+        if kind == 'epoch' or not self._resyncing:
+            self._resync()
+
+    def _resync(self):
+        leader = self.c._leader
+        response = self.c._scouts.request(leader, 'SNAPSHOT',
+                                            self.c.heartbeat_interval)
+        if response[:1] != ['snapshot'] or leader != self.c._leader:
+            self._resyncing = True
+            return
+        logger.debug("Got cluster snapshot")
+        self._epoch = int(response[1])
+        self._resyncing = False
+        self.c._cluster.replace(set(response[2:]))
 
     @autospawn
     def _poll_leader(self):
@@ -162,11 +283,16 @@ class PeerServer(Service):
         self.c = coordinator
         self._updates = self.c._zmq.socket(zmq.PUB)
         self._heartbeats = self.c._zmq.socket(zmq.PULL)
-        self._latest_heartbeats = {}
+        self._detector = failure_detector(self.c.detector,
+                                    self.c.heartbeat_interval,
+                                    self.c.heartbeat_interval * 2,
+                                    self.c.phi_threshold)
+        self._epoch = 0
 
-        def updater(add=None, remove=None):
-            if add: self._broadcast_cluster()
-        self.c._cluster.attach(updater)
+        def updater(added, removed):
+            if self.c.is_leader:
+                self._broadcast_delta(added, removed)
+        self.c._cluster.attach_changes(updater)
 
 
     def do_start(self):
@@ -176,36 +302,37 @@ class PeerServer(Service):
         self._receive_heartbeats()
         self._timeout_peers()
 
-    def _broadcast_cluster(self):
-        self._updates.send_multipart([self.c._identity] + list(self.c._cluster))
+    def _snapshot(self):
+        return ['snapshot', str(self._epoch)] + list(self.c._cluster)
+
+    def _broadcast_delta(self, added, removed):
+        self._epoch += 1
+        self._updates.send_multipart(['delta', str(self._epoch)] +
+            ['+' + host for host in added] + ['-' + host for host in removed])
 
     @autospawn
     def _send_heartbeats(self):
         while True:
             self.c.wait_for_promotion()
-            logger.debug("Broadcasting cluster.")
-            self._broadcast_cluster()
+            # Only the epoch, followers that are behind ask for a snapshot
+            self._updates.send_multipart(['epoch', str(self._epoch)])
             gevent.sleep(self.c.heartbeat_interval)
 
     @autospawn
     def _receive_heartbeats(self):
         while True:
             self.c.wait_for_promotion()
-            follower = self._heartbeats.recv()
+            follower = self._heartbeats.recv_multipart()[0]
             self.c._cluster.add(follower) # ignored if already added
-            self._latest_heartbeats[follower] = time.time()
+            self._detector.heartbeat(follower)
 
     @autospawn
     def _timeout_peers(self):
         while True:
-            to_remove = []
-            for follower in self._latest_heartbeats:
-                time_since_last = time.time() - self._latest_heartbeats[follower]
-                if time_since_last > self.c.heartbeat_interval * 2:
-                    to_remove.append(follower)
-            for follower in to_remove:
-                self.c._cluster.remove(follower)
-                del self._latest_heartbeats[follower]
+            with self.c._cluster.batch():
+                for follower in self._detector.suspects():
+                    self.c._cluster.remove(follower)
+                    self._detector.remove(follower)
             gevent.sleep(self.c.heartbeat_interval)
 
 
@@ -16,7 +16,7 @@ class Leadership(Service):
         self.identity = identity
         self.leader = None
         self.set = cluster
-        self._candidates = sorted(list(cluster))
+        self._candidates = sorted(cluster)
         self._promoted = Event()
         self._broadcaster = zmq_.socket(zmq.PUB)
         self._listener = zmq_.socket(zmq.SUB)
@@ -71,7 +71,7 @@ class Announcer(Service):
     def _announce(self):
         while True:
             if self.cluster.identity in self.cluster.set:
-                cluster_snapshot = sorted(list(self.cluster.set))
+                cluster_snapshot = sorted(self.cluster.set)
                 identity_index = cluster_snapshot.index(self.cluster.identity)
                 announcer_index = int(time.time()) % len(cluster_snapshot)
                 if announcer_index is identity_index:
@@ -7,10 +7,12 @@ from ginkgo import Setting
 
 from .numbers import NumberClient
 from .messaging.hub import MessageHub
+from .messaging.tracing import Traced
 from .coordination import Announcer
 from .coordination import Leadership
 from .cluster import ClusterCoordinator
 from .util import ObservableSet
+from .timers import TimerWheel
 
 logger = logging.getLogger(__name__)
 
@@ -20,12 +22,17 @@ class NumberGateway(Service):
     cluster_ = Setting('cluster', default=['127.0.0.1'])
 
     def __init__(self):
-        self.client = NumberClient(('127.0.0.1', 7776))
-        self.cluster = ClusterCoordinator(self.identity, self.leader)
+        self.timers = TimerWheel()
+        self.cluster = ClusterCoordinator(self.identity, self.leader,
+                                                    timers=self.timers)
         #self.cluster = Leadership(self.identity, ObservableSet(self.cluster_))
-        self.hub = MessageHub(self.cluster.set, self.identity)
+        self.hub = MessageHub(self.cluster.set, self.identity,
+                                                    timers=self.timers)
+        self.client = NumberClient(('127.0.0.1', 7776),
+                                                tracer=self.hub.tracer)
         self.announcer = Announcer(self.hub, self.cluster)
 
+        self.add_service(self.timers)
         self.add_service(self.cluster)
         self.add_service(self.hub)
         self.add_service(self.announcer)
@@ -36,7 +43,11 @@ class NumberGateway(Service):
 
     @autospawn
     def _bridge(self):
-        for number in self.client:
+        while True:
+            numbers = self.client.next_batch()
             if self.cluster.is_leader:
-                self.hub.publish('/numbers', number)
+                for number in numbers:
+                    if isinstance(number, Traced):
+                        self.hub.tracer.record(number.trace, 'bridge')
+                    self.hub.publish('/numbers', number)
             gevent.sleep(0)
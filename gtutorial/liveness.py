@@ -0,0 +1,109 @@
+"""
+Failure detectors built on heartbeat arrival times. Each one gives every
+peer a suspicion score and considers it failed once the score crosses its
+threshold. Times come from a monotonic clock.
+"""
+import math
+import collections
+
+from .util import monotonic
+
+class FailureDetector(object):
+    threshold = 1.0
+
+    def __init__(self):
+        self._last = {}
+
+    def heartbeat(self, peer, now=None):
+        self._last[peer] = monotonic() if now is None else now
+
+    def remove(self, peer):
+        self._last.pop(peer, None)
+
+    def suspicion(self, peer, now=None):
+        raise NotImplementedError()
+
+    def is_available(self, peer, now=None):
+        return peer in self._last and \
+                    self.suspicion(peer, now) < self.threshold
+
+    def suspects(self, now=None):
+        now = monotonic() if now is None else now
+        return [peer for peer in self._last
+                if self.suspicion(peer, now) >= self.threshold]
+
+    def suspicions(self, now=None):
+        now = monotonic() if now is None else now
+        return dict((peer, self.suspicion(peer, now)) for peer in self._last)
+
+    def __contains__(self, peer):
+        return peer in self._last
+
+class FixedTimeoutDetector(FailureDetector):
+    """Suspicion is the time since the last heartbeat over the timeout"""
+    def __init__(self, timeout):
+        super(FixedTimeoutDetector, self).__init__()
+        self.timeout = float(timeout)
+
+    def suspicion(self, peer, now=None):
+        now = monotonic() if now is None else now
+        return (now - self._last[peer]) / self.timeout
+
+class PhiAccrualDetector(FailureDetector):
+    """
+    Phi accrual failure detector (Hayashibara et al.). Heartbeat intervals
+    are modelled as a normal distribution over a sliding window, and phi is
+    -log10 of the probability that a heartbeat is still on its way. A phi
+    of 8 means a 1 in 10^8 chance of wrongly suspecting the peer. By
+    default one missed heartbeat is tolerated as an acceptable pause.
+    """
+    def __init__(self, interval, threshold=8.0, window=100, min_std=None,
+                                                    acceptable_pause=None):
+        super(PhiAccrualDetector, self).__init__()
+        self.interval = float(interval)
+        self.threshold = threshold
+        self.window = window
+        self.min_std = min_std or self.interval / 4
+        if acceptable_pause is None:
+            acceptable_pause = self.interval
+        self.acceptable_pause = acceptable_pause
+        self._intervals = {}
+
+    def heartbeat(self, peer, now=None):
+        now = monotonic() if now is None else now
+        if peer in self._last:
+            self._intervals[peer].append(now - self._last[peer])
+        else:
+            # Seed with the expected interval so a new peer can be judged
+            self._intervals[peer] = collections.deque(
+                [self.interval, self.interval / 2, self.interval * 1.5],
+                                                    maxlen=self.window)
+        self._last[peer] = now
+
+    def remove(self, peer):
+        super(PhiAccrualDetector, self).remove(peer)
+        self._intervals.pop(peer, None)
+
+    def suspicion(self, peer, now=None):
+        now = monotonic() if now is None else now
+        intervals = self._intervals[peer]
+        mean = sum(intervals) / len(intervals)
+        variance = sum((i - mean) ** 2 for i in intervals) / len(intervals)
+        std = max(math.sqrt(variance), self.min_std)
+        # Logistic approximation of the normal CDF
+        y = (now - self._last[peer] - mean - self.acceptable_pause) / std
+        # exp() overflows well before this for early heartbeats, whose phi
+        # is 0 anyway. Late ones underflow to a phi of inf.
+        y = max(y, -10.0)
+        e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+        if y > 0:
+            return -math.log10(e / (1.0 + e)) if e > 0 else float('inf')
+        return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+def failure_detector(kind, interval, timeout, threshold=8.0):
+    """Creates a 'phi' or 'fixed' timeout detector"""
+    if kind == 'phi':
+        return PhiAccrualDetector(interval, threshold)
+    elif kind == 'fixed':
+        return FixedTimeoutDetector(timeout)
+    raise ValueError("Unknown failure detector: {}".format(kind))
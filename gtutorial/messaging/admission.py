@@ -0,0 +1,113 @@
+"""
+Admission control for the streamers. New connections are rate limited by
+a token bucket per server as they are accepted, before a greenlet is
+spawned for them, and subscribers are capped overall and per channel.
+Rejected HTTP clients get a 503 and WebSockets are closed with 1013 (try
+again later). Limits apply per hub process.
+"""
+import collections
+
+from ..util import monotonic
+from .channels import normalize
+
+REJECTED = ('HTTP/1.1 503 Service Unavailable\r\nRetry-After: 1\r\n'
+            'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(1, rate)
+        self.tokens = self.burst
+        self.updated = monotonic()
+
+    def take(self):
+        """Takes a token, False if the bucket is empty"""
+        now = monotonic()
+        self.tokens = min(self.burst,
+                        self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class Admission(object):
+    def __init__(self, max_subscribers=0, max_per_channel=0, accept_rate=0,
+                                                            accept_burst=0):
+        """Limits of 0 are unlimited"""
+        self.max_subscribers = max_subscribers
+        self.max_per_channel = max_per_channel
+        self.accept_rate = accept_rate
+        self.accept_burst = accept_burst
+        self.subscribers = 0
+        self.channels = collections.Counter()
+        self.counters = collections.Counter()
+
+    def spawner(self, spawn):
+        """
+        Wraps a server's spawn so connections over the accept rate are sent
+        a 503 and closed right away, without spawning a greenlet. Each
+        server gets a bucket of its own, so a storm on one doesn't use up
+        the others' budget.
+        """
+        bucket = None
+        if self.accept_rate:
+            bucket = TokenBucket(self.accept_rate, self.accept_burst)
+        def admit(handle, socket, address):
+            if bucket is not None and not bucket.take():
+                self.counters['rejected_rate'] += 1
+                try:
+                    socket.sendall(REJECTED)
+                except IOError:
+                    pass
+                socket.close()
+                return
+            self.counters['accepted'] += 1
+            return spawn(handle, socket, address)
+        return admit
+
+    def admit(self, channel):
+        """Counts a new subscriber, False if a cap has been reached"""
+        channel = normalize(channel)
+        if self.max_subscribers and self.subscribers >= self.max_subscribers:
+            self.counters['rejected_subscribers'] += 1
+            return False
+        if self.max_per_channel and \
+                        self.channels[channel] >= self.max_per_channel:
+            self.counters['rejected_channel'] += 1
+            return False
+        self.subscribers += 1
+        self.channels[channel] += 1
+        self.counters['admitted'] += 1
+        return True
+
+    def release(self, channel):
+        channel = normalize(channel)
+        self.subscribers -= 1
+        self.channels[channel] -= 1
+        if not self.channels[channel]:
+            del self.channels[channel]
+
+    def guard(self, channel, start_response, response):
+        """
+        Admits a WSGI streaming response, which is released when it ends,
+        or answers 503 without starting it
+        """
+        if not self.admit(channel):
+            start_response('503 Service Unavailable', [
+                ('Content-Type', 'text/plain'),
+                ('Retry-After', '1'),])
+            return ["Too many subscribers\n"]
+        return self._released(channel, response)
+
+    def _released(self, channel, response):
+        try:
+            for chunk in response:
+                yield chunk
+        finally:
+            self.release(channel)
+            if hasattr(response, 'close'):
+                response.close()
+
+    def stats(self):
+        return dict(self.counters, subscribers=self.subscribers)
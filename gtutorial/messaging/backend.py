@@ -1,3 +1,9 @@
+import time
+import logging
+import itertools
+import collections
+
+import gevent
 import gevent.queue
 import msgpack
 
@@ -7,85 +13,738 @@ from ginkgo.core import Service, require_ready, autospawn
 from ginkgo import Setting
 
 from ..util import ObservableSet
+from .channels import ChannelIndex, CHANNEL_END, channel_filter, normalize
+from .framing import CODECS
+from . import framing
+from .tracing import Traced
+from .journal import Journal
+
+logger = logging.getLogger(__name__)
+
+_UNDECODED = object()
+
+BROADCAST = 'broadcast'
+INTEREST = 'interest'
+ROUTING_POLICIES = (BROADCAST, INTEREST)
+
+# Epoch of messages read from the journal, so their ids are log-<offset>
+JOURNAL_EPOCH = 'log'
+
+# Channel frame of a node's advertisement, a msgpack [host, filters] of its
+# interest followed by the framing versions it reads. Channel names never
+# start with a control character.
+INTEREST_FRAME = '\x01interest' + CHANNEL_END
+
+class Message(object):
+    """
+    A single frame received from the backend. It is created once per frame
+    and the same instance is handed to every subscription on the channel, so
+    the payload is decoded at most once and its text form is rendered at most
+    once. The decoded value is immutable (arrays unpack as tuples) since it
+    is shared, but the text form still writes arrays as lists, as it always
+    has. The original msgpack bytes are kept in `raw`.
+
+    Messages written to the journal by this process get their journal
+    `offset`, so subscribers can tell which live messages they already
+    read from the journal.
+
+    Messages are numbered per channel by the receiving node. `id` combines
+    that sequence with the epoch of the channel's history, which changes
+    when the node restarts or the history is dropped and created again, so
+    old ids are never mistaken for current ones.
+    """
+    __slots__ = ('channel', 'raw', 'epoch', 'sequence', 'trace', 'offset',
+                                            '_value', '_text', '_rendered')
+
+    def __init__(self, channel, raw, epoch=None, sequence=None):
+        self.channel = channel
+        self.raw = raw
+        self.epoch = epoch
+        self.sequence = sequence
+        self.trace = None
+        self.offset = None
+        self._value = _UNDECODED
+        self._text = None
+        self._rendered = None
+
+    @property
+    def id(self):
+        if self.sequence is None:
+            return None
+        return '{}-{}'.format(self.epoch, self.sequence)
+
+    @property
+    def value(self):
+        if self._value is _UNDECODED:
+            self._value = msgpack.unpackb(self.raw, use_list=False)
+        return self._value
+
+    def __str__(self):
+        if self._text is None:
+            value = self.value
+            if isinstance(value, str):
+                # Strings are passed through as is, no copy is made
+                self._text = value
+            else:
+                # A decode of its own, so arrays print as lists
+                self._text = str(msgpack.unpackb(self.raw, use_list=True))
+        return self._text
+
+    def __len__(self):
+        return len(str(self))
+
+    def render(self, renderer):
+        """
+        Returns renderer(message), calling the renderer only the first time
+        so every subscriber writing the same framing shares the same bytes.
+        """
+        if self._rendered is None:
+            self._rendered = {}
+        rendered = self._rendered.get(renderer)
+        if rendered is None:
+            rendered = self._rendered[renderer] = renderer(self)
+        return rendered
+
+    def __repr__(self):
+        return '<Message {} {!r}>'.format(self.channel, self.value)
+
+DROP_OLDEST = 'drop-oldest'
+DROP_NEWEST = 'drop-newest'
+COALESCE = 'coalesce'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DROP_NEWEST, COALESCE, DISCONNECT)
 
 class Subscription(gevent.queue.Queue):
-    def __init__(self, receiver, channel):
-        super(Subscription, self).__init__(maxsize=64)
+    """
+    Bounded queue of messages for one subscriber. The receiver never blocks
+    on it: when it is full the overflow policy decides what gets dropped.
+    With `disconnect`, new messages are dropped until `max_drops` is reached
+    and then the subscription is cancelled and iteration over it stops.
+    """
+    def __init__(self, receiver, channel, maxsize=64, overflow=DROP_OLDEST,
+                                                        max_drops=64):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy: {}".format(overflow))
+        super(Subscription, self).__init__(maxsize=maxsize)
         self.channel = channel
         self.receiver = receiver
+        self.overflow = overflow
+        self.max_drops = max_drops
+        self.delivered = 0
+        self.drops = 0
         self.receiver.subscribe(channel, self)
 
+    @property
+    def lag(self):
+        """Number of messages waiting to be consumed"""
+        return self.qsize()
+
+    def deliver(self, message):
+        """Puts a message without ever blocking, applying the overflow policy"""
+        if self.full():
+            self.drops += 1
+            if self.receiver.metrics is not None:
+                self.receiver.metrics.count('dropped')
+            if self.overflow == DROP_OLDEST:
+                self.get_nowait()
+            elif self.overflow == COALESCE:
+                self._clear()
+            elif self.overflow == DISCONNECT and self.drops >= self.max_drops:
+                logger.info("Disconnecting slow subscriber on {} after {} "
+                                "drops".format(self.channel, self.drops))
+                self.cancel()
+                self._clear()
+                self.put_nowait(StopIteration)
+                return
+            else:
+                return
+        self.put_nowait(message)
+        self.delivered += 1
+
     def cancel(self):
+        if self.channel is None:
+            return
         self.receiver.unsubscribe(self.channel, self)
         self.channel = None
 
+    def _clear(self):
+        while not self.empty():
+            self.get_nowait()
+
+class ChannelHistory(object):
+    """
+    Ring buffer of the latest messages on a channel, bounded both by count
+    and by payload bytes. It also hands out the channel's sequence numbers.
+    """
+    def __init__(self, epoch, size, max_bytes):
+        self.epoch = epoch
+        self.size = size
+        self.max_bytes = max_bytes
+        self.sequence = 0
+        self.bytes = 0
+        self.messages = collections.deque()
+
+    def message(self, channel, raw):
+        self.sequence += 1
+        message = Message(channel, raw, self.epoch, self.sequence)
+        if self.size:
+            self.messages.append(message)
+            self.bytes += len(raw)
+            while len(self.messages) > self.size or \
+                                self.bytes > self.max_bytes:
+                self.bytes -= len(self.messages.popleft().raw)
+        return message
+
+    def since(self, sequence):
+        """Returns the buffered messages that came after a sequence number"""
+        if not self.messages or sequence >= self.sequence:
+            return []
+        # Sequences in the buffer are contiguous
+        start = max(0, sequence - self.messages[0].sequence + 1)
+        return list(itertools.islice(self.messages, start, None))
+
 class MessageBackend(Service):
     port = Setting('backend_port', default=2222)
+    queue_size = Setting('subscription_queue_size', default=64)
+    overflow = Setting('subscription_overflow', default=DROP_OLDEST, help="""\
+        What to do when a subscriber's queue is full: drop-oldest,
+        drop-newest, coalesce (keep only the latest) or disconnect
+        """)
+    channel_overflow = Setting('subscription_overflow_channels', default={},
+        help="Overflow policy overrides keyed by channel")
+    max_drops = Setting('subscription_max_drops', default=64,
+        help="Drops before a subscriber is cut off with the disconnect policy")
+    batch_size = Setting('backend_batch_size', default=0, help="""\
+        Messages per channel packed into one frame before it is sent. Set to
+        0 to send every message on its own
+        """)
+    batch_bytes = Setting('backend_batch_bytes', default=65536,
+        help="Payload bytes after which a batch is sent early")
+    batch_window = Setting('backend_batch_window_ms', default=5,
+        help="Longest a message waits in a batch before it is sent")
+    replay_size = Setting('replay_buffer_size', default=100,
+        help="Messages kept per channel for replay to reconnecting clients")
+    replay_bytes = Setting('replay_buffer_bytes', default=262144,
+        help="Payload bytes kept per channel for replay")
+    replay_channels = Setting('replay_buffer_channels', default=1024,
+        help="Channels with a replay buffer, the oldest buffer is dropped")
+    routing = Setting('backend_routing', default=BROADCAST, help="""\
+        How published messages reach other nodes: broadcast (to every node)
+        or interest (only to nodes that advertised subscribers matching the
+        channel, which needs the bind interface to be the node's identity).
+        A node with journal_dir set subscribes to journal_channels and
+        advertises them like any subscriber, so with the default /* it
+        receives every channel
+        """)
+    terminate_channels = Setting('backend_terminate_channels', default=True,
+        help="""\
+        End channel frames with a NUL byte so exact subscriptions are
+        filtered by ZMQ. Nodes from before the terminator neither send nor
+        match it, so set this to false on every node for a rolling upgrade
+        from them and back to true once they are all gone. Until then exact
+        subscriptions also receive the frames of longer channel names, which
+        are dropped after the lookup.
+        """)
+    interest_interval = Setting('backend_interest_interval_secs', default=5,
+        help="How often nodes re-advertise their channel interest")
+    compression = Setting('backend_compression', default=None, help="""\
+        Codec for frames above the compression threshold: zlib, or lz4 if it
+        is installed. Compressed frames only go to nodes that advertised
+        versioned framing, which needs the bind interface to be the node's
+        identity. Other nodes are sent the frames uncompressed
+        """)
+    compression_threshold = Setting('backend_compression_threshold',
+        default=1024, help="Payload bytes from which a frame is compressed")
+    journal_dir = Setting('journal_dir', default=None, help="""\
+        Directory of the durable per-channel message log. Subscribers can
+        start from an offset or time in it. Disabled when not set. With
+        hub workers, subscribers catching up from it can miss or repeat
+        live messages around the switch from history to live
+        """)
+    journal_channels = Setting('journal_channels', default=['/*'], help="""\
+        Channel patterns written to the journal. The journal subscribes to
+        them like any subscriber, so with interest routing the node is
+        sent all traffic on them. Narrow them to keep interest routing
+        worthwhile on journaling nodes
+        """)
+    journal_segment_bytes = Setting('journal_segment_bytes', default=64 << 20)
+    journal_retention_bytes = Setting('journal_retention_bytes',
+        default=1 << 30, help="Journal bytes kept per channel")
+    journal_retention_secs = Setting('journal_retention_secs', default=86400,
+        help="Age after which journal segments are deleted")
+    journal_flush_secs = Setting('journal_flush_secs', default=1,
+        help="How often the journal is synced to disk and expired")
 
-    def __init__(self, cluster=None, bind_interface=None, zmq_=None):
+    def __init__(self, cluster=None, bind_interface=None, zmq_=None,
+                upstream=None, relay=None, metrics=None, tracer=None):
+        """
+        By default the backend binds its own subscriber socket and publishes
+        to every host in the cluster. Hub workers instead receive from the
+        `upstream` address and publish by pushing frames to the `relay`
+        address, both served by a PeerForwarder in the parent process.
+        The hot paths are instrumented when `metrics` is given, and traced
+        messages are stamped when there is a `tracer`.
+        """
+        if self.routing not in ROUTING_POLICIES:
+            raise ValueError("Unknown routing: {}".format(self.routing))
+        if self.compression is not None and self.compression not in CODECS:
+            raise ValueError("Unavailable codec: {}".format(self.compression))
         self.cluster = cluster or ObservableSet()
         self.zmq = zmq_ or zmq.Context()
+        self.identity = bind_interface
+        self.metrics = metrics
+        self.tracer = tracer
+        # ZMQ filters with subscribers on this node
+        self.interest = ObservableSet()
+
+        # Hub workers read the journal their parent writes
+        self.journal = None
+        if self.journal_dir:
+            self.journal = Journal(self.journal_dir,
+                    self.journal_segment_bytes, self.journal_retention_bytes,
+                    self.journal_retention_secs, readonly=relay is not None)
 
-        self.transmitter = PeerTransmitter(self)
-        self.receiver = PeerReceiver(self, bind_interface)
+        self.transmitter = PeerTransmitter(self, relay)
+        self.receiver = PeerReceiver(self, bind_interface, upstream)
 
         self.add_service(self.transmitter)
         self.add_service(self.receiver)
 
+    def do_start(self):
+        if self.journal is not None and not self.journal.readonly:
+            for pattern in self.journal_channels:
+                self.receiver.subscribe(pattern, self.journal)
+            self._maintain_journal()
+
+    @autospawn
+    def _maintain_journal(self):
+        while True:
+            gevent.sleep(self.journal_flush_secs)
+            self.journal.flush()
+            self.journal.expire()
+
     def publish(self, channel, message):
-        self.transmitter.broadcast(channel, message)
+        if isinstance(message, Traced):
+            self.transmitter.broadcast(channel, message.value, message.trace)
+        else:
+            self.transmitter.broadcast(channel, message)
+
+    def subscribe(self, channel, overflow=None):
+        overflow = overflow or self.channel_overflow.get(
+                        str(channel).lower(), self.overflow)
+        return Subscription(self.receiver, channel, self.queue_size, overflow,
+                                                            self.max_drops)
 
-    def subscribe(self, channel):
-        return Subscription(self.receiver, channel)
+    def replay(self, channel, last_id):
+        return self.receiver.replay(channel, last_id)
+
+    def history(self, channel, offset=None, since=None):
+        """
+        Returns an iterator over the messages journaled on a channel, from
+        an offset or a time. It keeps reading until it has caught up with
+        the journal. Subscribe first and then read the history: live
+        messages that queued up meanwhile and are at or below the last
+        offset read were sent with the history, and the ones the queue
+        dropped were journaled before that offset.
+
+        Hub workers read the journal their parent writes, so their live
+        messages have no offset to compare. There, live messages may
+        repeat history, or be lost if the queue overflowed while the
+        history was read.
+        """
+        if self.journal is None:
+            return iter([])
+        return self._read_history(normalize(channel), offset, since)
+
+    def _read_history(self, channel, offset, since):
+        while True:
+            caught_up = True
+            for offset, payload in self.journal.read(channel, offset, since):
+                message = Message(channel, payload, JOURNAL_EPOCH, offset)
+                message.offset = offset
+                yield message
+                caught_up = False
+            if caught_up:
+                return
+            offset, since = message.offset + 1, None
+
+    def stats(self, **extra):
+        """Subscribers and queued messages per pattern, with any metrics"""
+        channels = {}
+        for pattern, subscriptions in self.receiver.subscriptions.patterns():
+            lags = [subscription.lag for subscription in subscriptions]
+            channels[pattern] = {'subscribers': len(lags),
+                                'queued': sum(lags), 'max_queued': max(lags)}
+        if self.metrics is None:
+            return dict(extra, channels=channels)
+        return self.metrics.snapshot(channels=channels, **extra)
+
+class _Batch(object):
+    __slots__ = ('payloads', 'size')
+
+    def __init__(self):
+        self.payloads = []
+        self.size = 0
 
 class PeerTransmitter(Service):
-    def __init__(self, backend):
+    """
+    Publishes to the cluster. With interest routing there is a PUB socket
+    per host, and a channel is only sent to the hosts whose advertised
+    filters match it. Hosts that haven't advertised yet are sent everything.
+
+    Hosts also advertise the framing versions they read. Versioned frames
+    are downgraded for hosts that haven't advertised them, and with one
+    broadcast socket, unless every host in the cluster has.
+    """
+    def __init__(self, backend, relay=None):
         self.cluster = backend.cluster
+        self.interest = backend.interest
+        self.identity = backend.identity
         self.port = backend.port
-        self.socket = backend.zmq.socket(zmq.PUB)
+        self.relay = relay
+        self.routing = BROADCAST if relay else backend.routing
+        self.interest_interval = backend.interest_interval
+        self.metrics = backend.metrics
+        self.tracer = backend.tracer
+        self.zmq = backend.zmq
+        self.socket = backend.zmq.socket(zmq.PUSH if relay else zmq.PUB)
+        self.peers = {}
+        self.routes = {}
+        self.versions = {}
+        self._versioned_cluster = False
+        self._route_cache = {}
+        self.batch_size = backend.batch_size
+        self.batch_bytes = backend.batch_bytes
+        self.batch_window = backend.batch_window / 1000.0
+        self.compression = backend.compression
+        self.compression_threshold = backend.compression_threshold
+        self.channel_end = CHANNEL_END if backend.terminate_channels else ''
+        self._batches = {}
 
     def do_start(self):
-        def connector(add=None, remove=None):
-            if add: self.connect(add)
-        self.cluster.attach(connector)
+        if self.relay is not None:
+            self.socket.connect(self.relay)
+            return
+        def connector(added, removed):
+            for host in added:
+                self.connect(host)
+            for host in removed:
+                self.disconnect(host)
+            self._versioned_cluster = self._cluster_versioned()
+        self.cluster.attach_changes(connector)
         for host in self.cluster:
             self.connect(host)
+        if self.routing == INTEREST:
+            self.interest.attach_changes(lambda added, removed:
+                                                    self.advertise())
+        self._readvertise()
 
     def connect(self, host):
-        self.socket.connect("tcp://{}:{}".format(host, self.port))
+        address = "tcp://{}:{}".format(host, self.port)
+        if self.routing == BROADCAST:
+            self.socket.connect(address)
+        elif host not in self.peers:
+            self.peers[host] = self.zmq.socket(zmq.PUB)
+            self.peers[host].connect(address)
+            self._route_cache.clear()
+
+    def disconnect(self, host):
+        self.versions.pop(host, None)
+        socket = self.peers.pop(host, None)
+        if socket is not None:
+            socket.close()
+            self.routes.pop(host, None)
+            self._route_cache.clear()
+
+    def learn(self, host, filters, versions=()):
+        """Records the filters and framing versions a host advertised"""
+        filters, versions = frozenset(filters), frozenset(versions)
+        if host is None or (self.routes.get(host) == filters and
+                                    self.versions.get(host) == versions):
+            return
+        self.routes[host] = filters
+        self.versions[host] = versions
+        self._route_cache.clear()
+        self._versioned_cluster = self._cluster_versioned()
+
+    def _cluster_versioned(self):
+        return bool(len(self.cluster)) and all(framing.VERSION in
+            self.versions.get(host, ()) for host in self.cluster)
+
+    def advertise(self):
+        frames = [INTEREST_FRAME,
+                    msgpack.packb([self.identity, sorted(self.interest)]),
+                    msgpack.packb(framing.ACCEPTED)]
+        if self.routing == BROADCAST:
+            self.socket.send_multipart(frames)
+            return
+        for socket in self.peers.values():
+            socket.send_multipart(frames)
+
+    @autospawn
+    def _readvertise(self):
+        # Reaches hosts that joined since, or missed a change or the start
+        while True:
+            self.advertise()
+            gevent.sleep(self.interest_interval)
+
+    def send(self, frames):
+        """Sends frames to every host that should get their channel"""
+        if self.metrics is not None:
+            self.metrics.count('frames_sent')
+        versioned = framing.versioned(frames)
+        if self.routing == BROADCAST:
+            # Frames pushed to the relay are downgraded by the parent
+            if versioned and self.relay is None and \
+                                        not self._versioned_cluster:
+                frames = framing.downgrade(frames)
+            self.socket.send_multipart(frames)
+            return
+        downgraded = None
+        for socket, reads_versioned in self._route(frames[0]):
+            if not versioned or reads_versioned:
+                socket.send_multipart(frames)
+                continue
+            if downgraded is None:
+                downgraded = framing.downgrade(frames)
+            socket.send_multipart(downgraded)
+
+    def _route(self, channel):
+        """Returns (socket, reads versioned framing) for a channel"""
+        sockets = self._route_cache.get(channel)
+        if sockets is None:
+            if len(self._route_cache) >= 4096:
+                self._route_cache.clear()
+            sockets = self._route_cache[channel] = [(socket,
+                    framing.VERSION in self.versions.get(host, ()))
+                for host, socket in self.peers.items()
+                    if host not in self.routes or any(channel.startswith(f)
+                                            for f in self.routes[host])]
+        return sockets
+
+    def _encode(self, channel, payloads, trace=None):
+        # Not worth compressing what would be downgraded before sending
+        if self.relay is None and self.routing == BROADCAST and \
+                                        not self._versioned_cluster:
+            return framing.encode(channel, payloads)
+        return framing.encode(channel, payloads, self.compression,
+                                        self.compression_threshold, trace)
+
+    def do_stop(self):
+        for channel in self._batches.keys():
+            self.flush(channel)
 
     @require_ready
-    def broadcast(self, channel, message):
-        self.socket.send_multipart([str(channel).lower(), msgpack.packb(message)])
+    def broadcast(self, channel, message, trace=None):
+        """Publishes a message, traced ones are sent right away"""
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.count('published')
+            started = metrics.start()
+        channel = normalize(channel) + self.channel_end
+        payload = msgpack.packb(message)
+        if trace is not None and self.tracer is not None:
+            self.tracer.record(trace, 'publish')
+        else:
+            trace = None
+        if not self.batch_size or trace is not None:
+            if trace is not None:
+                # Messages batched before it go first, to keep their order
+                self.flush(channel)
+            self.send(self._encode(channel, [payload], trace))
+            if metrics is not None:
+                metrics.stop('publish', started)
+            return
+        batch = self._batches.get(channel)
+        if batch is None:
+            batch = self._batches[channel] = _Batch()
+            self.spawn_later(self.batch_window, self.flush, channel, batch)
+        batch.payloads.append(payload)
+        batch.size += len(payload)
+        if len(batch.payloads) >= self.batch_size or \
+                                    batch.size >= self.batch_bytes:
+            self.flush(channel)
+        if metrics is not None:
+            metrics.stop('publish', started)
+
+    def flush(self, channel, batch=None):
+        """Sends the pending batch for a channel. If a batch is given, it is
+        only sent if it is still the pending one."""
+        pending = self._batches.get(channel)
+        if pending is None or (batch is not None and batch is not pending):
+            return
+        del self._batches[channel]
+        self.send(self._encode(channel, pending.payloads))
 
 class PeerReceiver(Service):
-    def __init__(self, backend, bind_interface=None):
+    def __init__(self, backend, bind_interface=None, upstream=None):
         self.bind_address = (bind_interface or '0.0.0.0', backend.port)
+        self.upstream = upstream
         self.socket = backend.zmq.socket(zmq.SUB)
-        self.subscriptions = dict()
+        self.transmitter = backend.transmitter
+        self.interest = backend.interest
+        self.metrics = backend.metrics
+        self.tracer = backend.tracer
+        self.subscriptions = ChannelIndex()
+        # Local subscribers per ZMQ filter, so each filter is only
+        # subscribed upstream once per node
+        self.filters = collections.Counter()
+        self.terminate_channels = backend.terminate_channels
+        self.epoch = '{:x}'.format(int(time.time() * 1000))
+        self.histories = collections.OrderedDict()
+        self._generations = itertools.count()
+        self.replay_size = backend.replay_size
+        self.replay_bytes = backend.replay_bytes
+        self.replay_channels = backend.replay_channels
 
     def do_start(self):
-        self.socket.bind("tcp://{}:{}".format(*self.bind_address))
+        if self.upstream is not None:
+            self.socket.connect(self.upstream)
+        else:
+            self.socket.bind("tcp://{}:{}".format(*self.bind_address))
+        if self.transmitter.relay is None:
+            self.socket.setsockopt(zmq.SUBSCRIBE, INTEREST_FRAME)
         self._listen()
 
     def subscribe(self, channel, subscriber):
-        channel = str(channel).lower()
-
-        if self.subscriptions.get(channel) is None:
-            self.subscriptions[channel] = set()
+        pattern = normalize(channel)
 
-        self.socket.setsockopt(zmq.SUBSCRIBE, channel)
-        self.subscriptions[channel].add(subscriber)
+        if self.subscriptions.add(pattern, subscriber):
+            filter_ = channel_filter(pattern, self.terminate_channels)
+            if not self.filters[filter_]:
+                self.socket.setsockopt(zmq.SUBSCRIBE, filter_)
+                self.interest.add(filter_)
+            self.filters[filter_] += 1
 
     def unsubscribe(self, channel, subscriber):
-        channel = str(channel).lower()
+        pattern = normalize(channel)
 
-        self.socket.setsockopt(zmq.UNSUBSCRIBE, channel)
-        self.subscriptions[channel].remove(subscriber)
+        if self.subscriptions.remove(pattern, subscriber):
+            filter_ = channel_filter(pattern, self.terminate_channels)
+            self.filters[filter_] -= 1
+            if not self.filters[filter_]:
+                del self.filters[filter_]
+                self.socket.setsockopt(zmq.UNSUBSCRIBE, filter_)
+                self.interest.remove(filter_)
 
     @autospawn
     def _listen(self):
         while True:
-            channel, message = self.socket.recv_multipart()
-            for subscription in self.subscriptions.get(channel, []):
-                subscription.put(msgpack.unpackb(message))
+            frames = self.socket.recv_multipart()
+            if frames[0] == INTEREST_FRAME:
+                host, filters = msgpack.unpackb(frames[1])
+                versions = msgpack.unpackb(frames[2]) if len(frames) > 2 \
+                                                                else ()
+                self.transmitter.learn(host, filters, versions)
+                continue
+            channel = frames[0].rstrip(CHANNEL_END)
+            metrics = self.metrics
+            if metrics is not None:
+                metrics.count('frames_received')
+                started = metrics.start()
+            try:
+                payloads, trace = framing.decode(frames)
+            except ValueError as e:
+                logger.warning("Dropped frame on {}: {}".format(channel, e))
+                continue
+            if metrics is not None:
+                metrics.stop('decode', started)
+            self._deliver(channel, payloads, trace)
+
+    def replay(self, channel, last_id):
+        """Returns buffered messages on a channel after the message id"""
+        history = self.histories.get(normalize(channel))
+        epoch, _, sequence = str(last_id or '').partition('-')
+        if history is None or epoch != history.epoch or \
+                                            not sequence.isdigit():
+            return []
+        return history.since(int(sequence))
+
+    def _history(self, channel):
+        history = self.histories.get(channel)
+        if history is None:
+            if len(self.histories) >= self.replay_channels:
+                self.histories.popitem(last=False)
+            # Sequences start over, so each history gets its own epoch
+            epoch = '{}.{}'.format(self.epoch, next(self._generations))
+            history = self.histories[channel] = ChannelHistory(epoch,
+                                        self.replay_size, self.replay_bytes)
+        return history
+
+    def _dispatch(self, channel, *payloads):
+        self._deliver(channel, payloads)
+
+    def _deliver(self, channel, payloads, trace=None):
+        metrics = self.metrics
+        if metrics is not None:
+            metrics.count('received', len(payloads))
+            started = metrics.start()
+        tracer = self.tracer if trace is not None else None
+        if tracer is not None:
+            tracer.record(trace, 'receive')
+        subscriptions = self.subscriptions.match(channel)
+        if subscriptions:
+            history = self._history(channel)
+            for raw in payloads:
+                message = history.message(channel, raw)
+                if tracer is not None:
+                    message.trace = trace
+                for subscription in subscriptions:
+                    subscription.deliver(message)
+            if tracer is not None:
+                tracer.record(trace, 'dispatch')
+        if metrics is not None:
+            metrics.count('enqueued', len(payloads) * len(subscriptions))
+            metrics.stop('dispatch', started)
+
+class PeerForwarder(Service):
+    """
+    Lets several hub worker processes share one backend subscription. It
+    binds the node's backend port and forwards frames to the workers over
+    `upstream`. Subscriptions from the workers travel the other way, so the
+    cluster sees a single subscriber with the union of their filters, and
+    that union is the node's advertised interest. Frames the workers push
+    to `relay` are published to the cluster through the backend's
+    transmitter.
+    """
+    def __init__(self, backend, bind_interface, upstream, relay):
+        self.transmitter = backend.transmitter
+        self.interest = backend.interest
+        self.bind_address = (bind_interface or '0.0.0.0', backend.port)
+        self.upstream = upstream
+        self.relay = relay
+        self.frontend = backend.zmq.socket(zmq.XSUB)
+        self.downstream = backend.zmq.socket(zmq.XPUB)
+        self.published = backend.zmq.socket(zmq.PULL)
+
+    def do_start(self):
+        self.frontend.bind("tcp://{}:{}".format(*self.bind_address))
+        self.downstream.bind(self.upstream)
+        self.published.bind(self.relay)
+        self._forward(self.frontend, self.downstream)
+        self._forward_subscriptions()
+        self._relay()
+
+    @autospawn
+    def _forward(self, source, destination):
+        while True:
+            destination.send_multipart(source.recv_multipart())
+
+    @autospawn
+    def _forward_subscriptions(self):
+        # XPUB only passes on a filter's first subscribe and last unsubscribe
+        while True:
+            frames = self.downstream.recv_multipart()
+            self.frontend.send_multipart(frames)
+            filter_ = frames[0][1:]
+            if filter_ == INTEREST_FRAME:
+                continue
+            if frames[0][:1] == '\x01':
+                self.interest.add(filter_)
+            else:
+                self.interest.remove(filter_)
+
+    @autospawn
+    def _relay(self):
+        while True:
+            self.transmitter.send(self.published.recv_multipart())
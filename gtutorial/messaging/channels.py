@@ -0,0 +1,127 @@
+"""
+Channel names are slash separated paths. Subscriptions can use patterns:
+
+    /numbers        exactly /numbers
+    /numbers/*      anything below /numbers, at any depth
+    /numbers/+/avg  any single segment in place of the +
+
+"""
+PREFIX = '*'
+WILDCARD = '+'
+
+# Terminates the channel frame on the wire so ZMQ's prefix matching can be
+# used for exact subscriptions too. Nodes from before it send and filter on
+# bare channel names, see the backend_terminate_channels setting.
+CHANNEL_END = '\0'
+
+def normalize(channel):
+    return str(channel).lower()
+
+def channel_filter(pattern, terminated=True):
+    """
+    Returns the narrowest ZMQ subscription filter covering a pattern. An
+    unterminated filter for an exact pattern matches channel frames with
+    or without the terminator.
+    """
+    segments = pattern.split('/')
+    for index, segment in enumerate(segments):
+        if segment in (PREFIX, WILDCARD):
+            return '/'.join(segments[:index] + [''])
+    return pattern + CHANNEL_END if terminated else pattern
+
+class _Node(object):
+    __slots__ = ('children', 'exact', 'prefix')
+
+    def __init__(self):
+        self.children = {}
+        self.exact = set()
+        self.prefix = set()
+
+class ChannelIndex(object):
+    """
+    Trie of subscribers keyed by channel pattern segments. Matching a channel
+    walks one level per segment, so its cost depends on the depth of the
+    channel and not on how many channels are subscribed. Branches are pruned
+    as soon as their last subscriber is removed.
+    """
+    def __init__(self):
+        self._root = _Node()
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, pattern, subscriber):
+        """Adds a subscriber, returns False if it was already there"""
+        segments = pattern.split('/')
+        node = self._root
+        for segment in segments[:-1]:
+            node = node.children.setdefault(segment, _Node())
+        if segments[-1] == PREFIX:
+            subscribers = node.prefix
+        else:
+            node = node.children.setdefault(segments[-1], _Node())
+            subscribers = node.exact
+        if subscriber in subscribers:
+            return False
+        subscribers.add(subscriber)
+        self._size += 1
+        return True
+
+    def remove(self, pattern, subscriber):
+        """Removes a subscriber, returns False if it wasn't there"""
+        segments = pattern.split('/')
+        is_prefix = segments[-1] == PREFIX
+        if is_prefix:
+            segments = segments[:-1]
+        path = [(None, self._root)]
+        for segment in segments:
+            node = path[-1][1].children.get(segment)
+            if node is None:
+                return False
+            path.append((segment, node))
+        subscribers = path[-1][1].prefix if is_prefix else path[-1][1].exact
+        if subscriber not in subscribers:
+            return False
+        subscribers.remove(subscriber)
+        self._size -= 1
+        # Prune the branch back up to the first node still in use
+        while len(path) > 1:
+            segment, node = path.pop()
+            if node.children or node.exact or node.prefix:
+                break
+            del path[-1][1].children[segment]
+        return True
+
+    def patterns(self):
+        """Yields (pattern, subscribers) for every subscribed pattern"""
+        stack = [([], self._root)]
+        while stack:
+            segments, node = stack.pop()
+            if node.exact:
+                yield '/'.join(segments), node.exact
+            if node.prefix:
+                yield '/'.join(segments + [PREFIX]), node.prefix
+            for segment, child in node.children.items():
+                stack.append((segments + [segment], child))
+
+    def match(self, channel):
+        """Returns the set of subscribers for a concrete channel"""
+        matches = set()
+        nodes = [self._root]
+        for segment in channel.split('/'):
+            next_nodes = []
+            for node in nodes:
+                matches.update(node.prefix)
+                child = node.children.get(segment)
+                if child is not None:
+                    next_nodes.append(child)
+                child = node.children.get(WILDCARD)
+                if child is not None:
+                    next_nodes.append(child)
+            if not next_nodes:
+                return matches
+            nodes = next_nodes
+        for node in nodes:
+            matches.update(node.exact)
+        return matches
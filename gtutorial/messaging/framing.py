@@ -0,0 +1,99 @@
+"""
+Frames on the backend wire. The first frame is always the channel, which
+ZMQ subscriptions filter on. Every version understands:
+
+    [channel, payload]
+    [channel, 'batch', msgpack list of payloads]
+
+Compressed frames use versioned framing, where the second frame is a
+header of the version followed by options:
+
+    [channel, 'v1 zlib', compressed payload]
+    [channel, 'v1 batch zlib', compressed msgpack list of payloads]
+    [channel, 'v1 trace', payload, msgpack trace stamps]
+
+Frames below the compression threshold and without a trace are sent the
+old way. Nodes that predate versioned framing would hand the header to
+subscribers as a payload, so every node advertises the versions it reads
+and versioned frames are only sent to nodes that advertised them. Other
+nodes get the downgraded frames: the same payloads, uncompressed and
+without the trace.
+"""
+import zlib
+
+import msgpack
+
+try:
+    import lz4
+    lz4 = getattr(lz4, 'block', lz4)
+except ImportError:
+    lz4 = None
+
+VERSION = 'v1'
+
+# Framing versions this node reads, as advertised to other nodes
+ACCEPTED = [VERSION]
+
+# Marks a frame carrying a msgpack list of packed messages for one channel
+BATCH = 'batch'
+
+TRACE = 'trace'
+
+CODECS = {'zlib': (zlib.compress, zlib.decompress)}
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.compress, lz4.decompress)
+
+def encode(channel, payloads, codec=None, threshold=0, trace=None):
+    """Returns the frames for payloads packed for a channel"""
+    if len(payloads) == 1:
+        body, options = payloads[0], []
+    else:
+        body, options = msgpack.packb(payloads), [BATCH]
+    compressed = codec is not None and len(body) >= threshold
+    if not compressed and trace is None:
+        return [channel] + options + [body]
+    if compressed:
+        body = CODECS[codec][0](body)
+        options.append(codec)
+    frames = [channel, None, body]
+    if trace is not None:
+        options.append(TRACE)
+        frames.append(msgpack.packb(trace))
+    frames[1] = ' '.join([VERSION] + options)
+    return frames
+
+def versioned(frames):
+    return len(frames) > 2 and frames[1] != BATCH
+
+def downgrade(frames):
+    """Returns frames nodes without versioned framing can read"""
+    if not versioned(frames):
+        return frames
+    payloads, _ = decode(frames)
+    return encode(frames[0], payloads)
+
+def decode(frames):
+    """
+    Returns the payloads in frames and their trace, if any. Raises
+    ValueError if they can't be read.
+    """
+    if len(frames) == 2:
+        return [frames[1]], None
+    if frames[1] == BATCH:
+        return msgpack.unpackb(frames[2]), None
+    options = frames[1].split(' ')
+    if options[0] != VERSION:
+        raise ValueError("Unknown framing {!r}".format(options[0]))
+    body = frames[2]
+    for option in options[1:]:
+        if option in CODECS:
+            try:
+                body = CODECS[option][1](body)
+            except Exception as e:
+                raise ValueError("Corrupt {} frame: {}".format(option, e))
+        elif option not in (BATCH, TRACE):
+            raise ValueError("Unknown frame option {!r}".format(option))
+    trace = msgpack.unpackb(frames[3]) if TRACE in options else None
+    if BATCH in options:
+        return msgpack.unpackb(body), trace
+    return [body], trace
@@ -1,4 +1,4 @@
-import random
+import uuid
 import socket
 import json
 import socket
@@ -9,11 +9,19 @@ import gevent.pywsgi
 import gevent.queue
 import webob
 
-from ginkgo.core import Service, autospawn
+from ginkgo.core import Service
 from ginkgo import Setting
 
+from .backend import JOURNAL_EPOCH
+
 logger = logging.getLogger(__name__)
 
+STATS_PATH = '/_stats'
+
+def line(msg):
+    """Renders a message for the plain stream"""
+    return '{}\n'.format(msg)
+
 class HttpStreamer(Service):
     port = Setting('pubsub_port', default=8088)
     keepalive_interval = Setting('keepalive_interval', default=5)
@@ -23,9 +31,9 @@ class HttpStreamer(Service):
 
         self.add_service(
             gevent.pywsgi.WSGIServer(
-                listener=(self.hub.bind_interface, self.port),
+                listener=self.hub.listener(self.port),
                 application=self.handle,
-                spawn=self.spawn,
+                spawn=self.hub.admission.spawner(self.spawn),
                 log=None))
 
         # This isn't the best we can do, but it makes things better
@@ -35,7 +43,14 @@ class HttpStreamer(Service):
         if env['REQUEST_METHOD'] == 'POST':
             return self.handle_publish(env, start_response)
         elif env['REQUEST_METHOD'] == 'GET':
-            return self.handle_subscribe(env, start_response)
+            if env.get('PATH_INFO') == STATS_PATH:
+                return self.handle_stats(env, start_response)
+            if 'text/event-stream' in env.get('HTTP_ACCEPT', ''):
+                response = self.handle_events(env, start_response)
+            else:
+                response = self.handle_subscribe(env, start_response)
+            return self.hub.admission.guard(env.get('PATH_INFO', ''),
+                                                start_response, response)
         else:
             start_response('405 Method not allowed', [])
             return ["Method not allowed\n"]
@@ -49,66 +64,208 @@ class HttpStreamer(Service):
             ('Content-Type', 'text/plain')])
         return ["OK\n"]
 
+    def handle_stats(self, env, start_response):
+        start_response('200 OK', [
+            ('Content-Type', 'application/json'),
+            ('Cache-Control', 'no-cache, must-revalidate'),])
+        return [json.dumps(self.hub.all_stats()), "\n"]
+
     def handle_subscribe(self, env, start_response):
         request = webob.Request(env)
         subscription = self.hub.subscribe(request.path)
+        try:
+            history = self.history(request)
+        except ValueError:
+            subscription.cancel()
+            start_response('400 Bad Request', [])
+            yield "Bad offset or since\n"
+            return
         self.keepalive(subscription)
         logger.info("New subscriber (stream)")
+        metrics, tracer = self.hub.metrics, self.hub.tracer
 
         start_response('200 OK', [
             ('Connection', 'keep-alive'),
             ('Cache-Control', 'no-cache, must-revalidate'),
             ('Expires', 'Tue, 11 Sep 1985 19:00:00 GMT'),])
         try:
+            read = None
+            for msg in history:
+                read = msg.offset
+                yield msg.render(line)
             for msg in subscription:
                 if msg is None:
                     yield '\n'
-                else:
-                    yield '{}\n'.format(msg)
+                elif not self._journaled(msg, read):
+                    if metrics is not None:
+                        metrics.count('http_written')
+                    if msg.trace is not None and tracer is not None:
+                        tracer.finish(msg.trace, 'write')
+                    yield msg.render(line)
         except:
             subscription.cancel()
             logger.info("Lost subscriber")
 
-    @autospawn
+    def handle_events(self, env, start_response):
+        """
+        Streams messages as Server-Sent Events. Reconnecting clients send the
+        last id they saw and get what they missed replayed from the channel's
+        buffer before the live stream continues. Ids of journaled messages
+        resume from the journal instead.
+        """
+        request = webob.Request(env)
+        last_id = request.headers.get('Last-Event-ID')
+        subscription = self.hub.subscribe(request.path)
+        replay = self.hub.replay(request.path, last_id)
+        try:
+            history = self.history(request, last_id)
+        except ValueError:
+            subscription.cancel()
+            start_response('400 Bad Request', [])
+            yield "Bad offset or since\n"
+            return
+        self.keepalive(subscription)
+        logger.info("New subscriber (events, {} replayed)".format(len(replay)))
+        metrics, tracer = self.hub.metrics, self.hub.tracer
+
+        start_response('200 OK', [
+            ('Content-Type', 'text/event-stream'),
+            ('Connection', 'keep-alive'),
+            ('Cache-Control', 'no-cache, must-revalidate'),
+            ('Expires', 'Tue, 11 Sep 1985 19:00:00 GMT'),])
+        try:
+            read = None
+            for msg in history:
+                read = msg.offset
+                yield msg.render(self._event)
+            # Live messages up to the last replayed one are skipped, unless
+            # the channel's history was dropped and numbered again since
+            replayed_epoch, replayed = (replay[-1].epoch,
+                        replay[-1].sequence) if replay else (None, 0)
+            for msg in replay:
+                yield msg.render(self._event)
+            for msg in subscription:
+                if msg is None:
+                    yield ':\n\n'
+                elif (msg.epoch != replayed_epoch or msg.sequence > replayed) \
+                                    and not self._journaled(msg, read):
+                    if metrics is not None:
+                        metrics.count('events_written')
+                    if msg.trace is not None and tracer is not None:
+                        tracer.finish(msg.trace, 'write')
+                    yield msg.render(self._event)
+        except:
+            subscription.cancel()
+            logger.info("Lost subscriber")
+
+    def history(self, request, last_id=None):
+        """
+        Journaled messages asked for with ?offset= (negative counts back
+        from the latest) or ?since= (a unix time). Raises ValueError for
+        malformed values. EventSource reconnects to the same URL, so with a
+        last event id they are ignored: journaled ids resume from the
+        journal, and other ids only get the replay buffer.
+        """
+        if last_id:
+            epoch, _, sequence = last_id.partition('-')
+            if epoch == JOURNAL_EPOCH and sequence.isdigit():
+                return self.hub.history(request.path,
+                                        offset=int(sequence) + 1)
+            return iter([])
+        offset, since = request.GET.get('offset'), request.GET.get('since')
+        if offset is None and since is None:
+            return iter([])
+        return self.hub.history(request.path,
+                    offset=None if offset is None else int(offset),
+                    since=None if since is None else float(since))
+
+    @staticmethod
+    def _journaled(msg, read):
+        """True for a live message already sent with the history"""
+        return read is not None and msg.offset is not None and \
+                                            msg.offset <= read
+
+    @staticmethod
+    def _event(msg):
+        return 'id: {}\ndata: {}\n\n'.format(msg.id,
+                        str(msg).replace('\n', '\ndata: '))
+
     def keepalive(self, subscription):
-        while subscription.channel is not None:
-            subscription.put(None)
-            gevent.sleep(self.keepalive_interval)
+        """
+        Puts a None in the subscription whenever it had no messages for a
+        keepalive interval. Checks run on the hub's timer wheel.
+        """
+        def check(seen):
+            if subscription.channel is None:
+                return
+            if subscription.delivered == seen and not subscription.full():
+                subscription.put_nowait(None)
+            self.hub.timers.schedule(self.keepalive_interval, check,
+                                                subscription.delivered)
+        subscription.put_nowait(None)
+        self.hub.timers.schedule(self.keepalive_interval, check,
+                                            subscription.delivered)
+
+
+class MultipartFramer(object):
+    """
+    Renders messages as parts of a multipart/x-mixed-replace stream. The
+    fixed parts of a frame are rendered once when the framer is created.
+    """
+    def __init__(self, boundary):
+        self.boundary = boundary
+        self.content_type = 'multipart/x-mixed-replace; boundary={}'.format(
+                                                                    boundary)
+        self.opening = '--{}\n'.format(boundary)
+        self._head = 'Content-Type: text/plain\nContent-Length: '
+        self._tail = '\n--{}\n'.format(boundary)
 
+    def frame(self, msg):
+        text = str(msg)
+        return ''.join((self._head, str(len(text)), '\n\n', text, self._tail))
 
 class HttpTailViewer(Service):
     port = Setting('tail_port', default=8089)
 
     def __init__(self, hub):
         self.hub = hub
+        # One boundary for all viewers so a message is framed only once
+        self.framer = MultipartFramer(uuid.uuid4().hex)
 
         self.add_service(
             gevent.pywsgi.WSGIServer(
-                listener=(self.hub.bind_interface, self.port),
+                listener=self.hub.listener(self.port),
                 application=self.handle,
-                spawn=self.spawn,
+                spawn=self.hub.admission.spawner(self.spawn),
                 log=None))
 
         # This isn't the best we can do, but it makes things better
         self.catch(socket.error, lambda e,g: None)
 
     def handle(self, env, start_response):
+        return self.hub.admission.guard(env.get('PATH_INFO', ''),
+                start_response, self.handle_tail(env, start_response))
+
+    def handle_tail(self, env, start_response):
         request = webob.Request(env)
         subscription = self.hub.subscribe(request.path)
         logger.info("New subscriber (tail view)")
+        metrics, tracer = self.hub.metrics, self.hub.tracer
 
-        boundary = str(random.random())
         start_response('200 OK', [
-            ('Content-Type', 'multipart/x-mixed-replace; boundary={}'.format(boundary)),
+            ('Content-Type', self.framer.content_type),
             ('Connection', 'keep-alive'),
             ('Cache-Control', 'no-cache, must-revalidate'),
             ('Expires', 'Tue, 11 Sep 1985 19:00:00 GMT'),])
-        yield '--{}\n'.format(boundary)
-        for msg in subscription:
-            if msg is not None:
-                yield '\n'.join([
-                    'Content-Type: text/plain',
-                    'Content-Length: {}'.format(len(msg)),
-                    '\n{}'.format(msg),
-                    '--{}\n'.format(boundary)])
+        try:
+            yield self.framer.opening
+            for msg in subscription:
+                if msg is not None:
+                    if metrics is not None:
+                        metrics.count('tail_written')
+                    if msg.trace is not None and tracer is not None:
+                        tracer.finish(msg.trace, 'write')
+                    yield msg.render(self.framer.frame)
+        finally:
+            subscription.cancel()
 
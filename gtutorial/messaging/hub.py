@@ -1,25 +1,222 @@
+import os
+import json
+import signal
+import socket
+import logging
+
+import gevent
 import gevent.queue
+import gevent.socket
+from gevent_zeromq import zmq
 from ginkgo.core import Service, autospawn
+from ginkgo import Setting
 
 from .http import HttpStreamer
 from .http import HttpTailViewer
 from .websocket import WebSocketStreamer
 from .backend import MessageBackend
+from .backend import PeerForwarder
+from .metrics import Metrics
+from .tracing import Tracer
+from .admission import Admission
+from ..timers import TimerWheel
+
+# Not exposed by the socket module on Python 2
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+logger = logging.getLogger(__name__)
 
 class MessageHub(Service):
-    def __init__(self, cluster=None, bind_interface=None, zmq=None):
+    workers = Setting('hub_workers', default=1, help="""\
+        Processes serving subscribers. With more than one, workers are
+        forked when the hub is created and share the listening ports
+        """)
+    listen_backlog = Setting('hub_listen_backlog', default=1024)
+    metrics_enabled = Setting('hub_metrics', default=False, help="""\
+        Count and time publishing, receiving, fan-out and socket writes,
+        served as JSON on the pubsub port at /_stats. With workers, /_stats
+        has the parent's stats and every worker's, which workers report
+        every hub_metrics_interval_secs and when they serve /_stats
+        """)
+    metrics_sample = Setting('hub_metrics_sample', default=16,
+        help="Time one in this many operations of each kind")
+    metrics_channel = Setting('hub_metrics_channel', default=None,
+        help="Channel the hub's stats are published on, if any")
+    metrics_interval = Setting('hub_metrics_interval_secs', default=10)
+    max_subscribers = Setting('hub_max_subscribers', default=0,
+        help="Subscribers a hub process serves at once, 0 for no limit")
+    max_channel_subscribers = Setting('hub_max_channel_subscribers',
+        default=0, help="Subscribers per channel, 0 for no limit")
+    accept_rate = Setting('hub_accept_rate', default=0, help="""\
+        New connections accepted per second by each streamer's server,
+        0 for no limit. Connections over it get a 503 right away
+        """)
+    accept_burst = Setting('hub_accept_burst', default=0,
+        help="Connections accepted at once above the rate, defaults to it")
+    trace_sample = Setting('hub_trace_sample', default=0, help="""\
+        Trace one in this many reads of the numbers client from the read
+        to the subscriber's socket, 0 to disable tracing
+        """)
+
+    def __init__(self, cluster=None, bind_interface=None, zmq=None,
+                    timers=None, upstream=None, stats_address=None):
+        """
+        With hub_workers above 1 this hub only owns the node's backend
+        traffic. It forks the workers right away, before any greenlets run.
+        Each worker is a MessageHub given the `upstream` addresses of this
+        hub's PeerForwarder, and it serves the HTTP and WebSocket streamers
+        on SO_REUSEPORT listeners. Workers report their stats to this hub
+        at `stats_address`.
+        """
         self.bind_interface = bind_interface
+        self.upstream = upstream
+        self.stats_address = stats_address
+        self.forwarder = None
+        self.worker_pids = []
+        self.worker_stats = {}
+        self.metrics = None
+        if self.metrics_enabled:
+            self.metrics = Metrics(self.metrics_sample)
+        self.admission = Admission(self.max_subscribers,
+                self.max_channel_subscribers, self.accept_rate,
+                self.accept_burst)
+        self.tracer = None
+        if self.trace_sample:
+            self.tracer = Tracer(bind_interface, self.trace_sample)
+
+        if timers is None:
+            timers = TimerWheel()
+            self.add_service(timers)
+        self.timers = timers
 
-        self.backend = MessageBackend(cluster, bind_interface, zmq)
+        if self.workers > 1 and upstream is None:
+            ipc = 'ipc:///tmp/gtutorial-hub-{}'.format(os.getpid())
+            upstream = (ipc + '-sub', ipc + '-pub')
+            self.stats_address = ipc + '-stats'
+            for _ in xrange(self.workers):
+                self._fork_worker(upstream)
+            self.backend = MessageBackend(cluster, bind_interface, zmq,
+                upstream[0], metrics=self.metrics, tracer=self.tracer)
+            self.forwarder = PeerForwarder(self.backend, bind_interface,
+                                                            *upstream)
+            self.add_service(self.forwarder)
+            self.add_service(self.backend)
+            return
+
+        self.backend = MessageBackend(cluster, bind_interface, zmq,
+                    *(upstream or (None, None)), metrics=self.metrics,
+                    tracer=self.tracer)
         self.add_service(self.backend)
 
         self.add_service(HttpStreamer(self))
         self.add_service(HttpTailViewer(self))
         self.add_service(WebSocketStreamer(self))
 
+    def do_start(self):
+        if self.metrics is not None and self.metrics_channel:
+            self._publish_stats()
+        if self.worker_pids:
+            self._collect_stats()
+        elif self.stats_address is not None:
+            self._report_stats()
+
+    def do_stop(self):
+        for pid in self.worker_pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def listener(self, port):
+        """Returns what streamers should listen on for a port"""
+        address = (self.bind_interface or '0.0.0.0', port)
+        if self.upstream is None:
+            return address
+        listener = gevent.socket.socket()
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        listener.bind(address)
+        listener.listen(self.listen_backlog)
+        return listener
+
+    def _fork_worker(self, upstream):
+        pid = gevent.fork()
+        if pid:
+            self.worker_pids.append(pid)
+            return
+        try:
+            logger.info("Hub worker {} started".format(os.getpid()))
+            MessageHub(bind_interface=self.bind_interface, upstream=upstream,
+                    stats_address=self.stats_address).serve_forever()
+        finally:
+            os._exit(0)
+
     def publish(self, channel, message):
         self.backend.publish(channel, message)
 
-    def subscribe(self, channel):
-        return self.backend.subscribe(channel)
+    def subscribe(self, channel, overflow=None):
+        return self.backend.subscribe(channel, overflow)
+
+    def replay(self, channel, last_id):
+        return self.backend.replay(channel, last_id)
+
+    def history(self, channel, offset=None, since=None):
+        return self.backend.history(channel, offset, since)
+
+    def stats(self):
+        """Stats of this process"""
+        extra = {'identity': self.bind_interface, 'pid': os.getpid(),
+                'admission': self.admission.stats()}
+        if self.tracer is not None:
+            extra['traces_ms'] = self.tracer.summary()
+        return self.backend.stats(**extra)
+
+    def all_stats(self):
+        """
+        Stats of this process, or in a worker, the parent's along with the
+        latest of every worker's. Falls back to the worker's own when the
+        parent doesn't answer.
+        """
+        stats = self.stats()
+        if self.upstream is None or self.stats_address is None:
+            return stats
+        everything = self._report(stats)
+        if everything is None:
+            return {'parent': None, 'workers': {str(stats['pid']): stats}}
+        return everything
+
+    def _report(self, stats):
+        socket = self.backend.zmq.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(self.stats_address)
+        try:
+            socket.send(json.dumps(stats))
+            with gevent.Timeout(1, False):
+                return json.loads(socket.recv())
+        finally:
+            socket.close()
+
+    @autospawn
+    def _report_stats(self):
+        while True:
+            gevent.sleep(self.metrics_interval)
+            self._report(self.stats())
+
+    @autospawn
+    def _collect_stats(self):
+        socket = self.backend.zmq.socket(zmq.REP)
+        socket.bind(self.stats_address)
+        while True:
+            stats = json.loads(socket.recv())
+            self.worker_stats[str(stats['pid'])] = stats
+            workers = dict((pid, stats)
+                    for pid, stats in self.worker_stats.items()
+                        if int(pid) in self.worker_pids)
+            socket.send(json.dumps({'parent': self.stats(),
+                                                'workers': workers}))
 
+    @autospawn
+    def _publish_stats(self):
+        while True:
+            gevent.sleep(self.metrics_interval)
+            self.publish(self.metrics_channel, json.dumps(self.stats()))
@@ -0,0 +1,259 @@
+"""
+Durable per-channel message log on local disk. Each channel has a
+directory of segment files named by the offset of their first message.
+A segment is sized up front and memory mapped, so appending copies the
+payload into the map and reading hands out buffers over the map without
+copying. Old segments are deleted by size and by age.
+
+Records are a header of payload length and receive time followed by the
+payload. The payload is written before the header, so a reader mapping
+the same file from another process never sees a partial record.
+"""
+import os
+import time
+import mmap
+import array
+import bisect
+import struct
+import urllib
+import logging
+
+import gevent
+
+logger = logging.getLogger(__name__)
+
+RECORD = struct.Struct('!Id')
+SEGMENT_SUFFIX = '.seg'
+
+# Records read between yields to other greenlets
+READ_CHUNK = 64
+
+class Segment(object):
+    def __init__(self, path, base, size=None, readonly=False):
+        self.path = path
+        self.base = base
+        if size is not None:
+            with open(path, 'wb') as file_:
+                file_.truncate(size) # sparse until written
+        with open(path, 'rb' if readonly else 'r+b') as file_:
+            self.map = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ
+                                    if readonly else mmap.ACCESS_WRITE)
+        self.positions = array.array('L')
+        self.times = array.array('d')
+        self.end = 0
+        self.scan()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def scan(self):
+        """Indexes records appended since the last scan"""
+        while self.end + RECORD.size <= len(self.map):
+            length, timestamp = RECORD.unpack_from(self.map, self.end)
+            size = RECORD.size + length
+            if not length or self.end + size > len(self.map):
+                break
+            self.positions.append(self.end)
+            self.times.append(timestamp)
+            self.end += size
+
+    def append(self, payload, timestamp):
+        """Appends a record, False if the segment has no room for it"""
+        start = self.end + RECORD.size
+        if start + len(payload) > len(self.map):
+            return False
+        self.map[start:start + len(payload)] = payload
+        RECORD.pack_into(self.map, self.end, len(payload), timestamp)
+        self.positions.append(self.end)
+        self.times.append(timestamp)
+        self.end = start + len(payload)
+        return True
+
+    def read(self, index):
+        """Returns a buffer over a record's payload and its timestamp"""
+        position = self.positions[index]
+        length, timestamp = RECORD.unpack_from(self.map, position)
+        return buffer(self.map, position + RECORD.size, length), timestamp
+
+    def flush(self):
+        self.map.flush()
+
+class ChannelJournal(object):
+    """
+    The segments of one channel. Offsets number a channel's messages from
+    0 and survive restarts. The map of a deleted segment stays valid for
+    as long as buffers over it are around.
+    """
+    def __init__(self, path, segment_bytes, retention_bytes, retention_secs,
+                                                        readonly=False):
+        self.path = path
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_secs = retention_secs
+        self.readonly = readonly
+        self.segments = []
+        if not readonly and not os.path.isdir(path):
+            os.makedirs(path)
+        self.refresh()
+        if not self.segments and not readonly:
+            self._roll(0)
+
+    @property
+    def start(self):
+        return self.segments[0].base if self.segments else 0
+
+    @property
+    def end(self):
+        if not self.segments:
+            return 0
+        return self.segments[-1].base + len(self.segments[-1])
+
+    @property
+    def bytes(self):
+        return sum(segment.end for segment in self.segments)
+
+    def refresh(self):
+        """Picks up segments and records written by another process"""
+        bases = sorted(int(name[:-len(SEGMENT_SUFFIX)])
+                        for name in os.listdir(self.path)
+                            if name.endswith(SEGMENT_SUFFIX))
+        last = self.segments[-1].base if self.segments else -1
+        self.segments = [segment for segment in self.segments
+                                        if segment.base in bases]
+        known = set(segment.base for segment in self.segments)
+        for base in bases:
+            if base not in known:
+                self.segments.append(Segment(self._segment_path(base), base,
+                                                readonly=self.readonly))
+        self.segments.sort(key=lambda segment: segment.base)
+        # The previous last segment may have grown before the next one
+        for segment in self.segments:
+            if segment.base >= last:
+                segment.scan()
+
+    def append(self, payload, timestamp):
+        """Appends a message, returns its offset"""
+        offset = self.end
+        if not self.segments[-1].append(payload, timestamp):
+            self._roll(RECORD.size + len(payload))
+            self.segments[-1].append(payload, timestamp)
+        return offset
+
+    def offset_at(self, timestamp):
+        """Returns the offset of the first message at or after a time"""
+        for segment in self.segments:
+            if segment.times and segment.times[-1] >= timestamp:
+                return segment.base + bisect.bisect_left(segment.times,
+                                                            timestamp)
+        return self.end
+
+    def read(self, offset, end):
+        """Yields (offset, payload buffer, timestamp) up to end"""
+        count = 0
+        while offset < end and self.segments:
+            offset = max(offset, self.start)
+            index = bisect.bisect_right([segment.base
+                            for segment in self.segments], offset) - 1
+            segment = self.segments[index]
+            while offset < end and offset - segment.base < len(segment):
+                payload, timestamp = segment.read(offset - segment.base)
+                yield offset, payload, timestamp
+                offset += 1
+                count += 1
+                if not count % READ_CHUNK:
+                    gevent.sleep(0)
+            if index == len(self.segments) - 1:
+                break
+
+    def expire(self, now=None):
+        """Deletes the oldest segments beyond the retention size or age"""
+        now = now or time.time()
+        while len(self.segments) > 1:
+            oldest = self.segments[0]
+            if self.bytes <= self.retention_bytes and (not oldest.times or
+                        oldest.times[-1] >= now - self.retention_secs):
+                break
+            self.segments.pop(0)
+            os.remove(oldest.path)
+            logger.debug("Expired journal segment {}".format(oldest.path))
+
+    def flush(self):
+        for segment in self.segments:
+            segment.flush()
+
+    def _roll(self, size):
+        if self.segments:
+            self.segments[-1].flush()
+        base = self.end
+        self.segments.append(Segment(self._segment_path(base), base,
+                                    max(self.segment_bytes, size)))
+        self.expire()
+
+    def _segment_path(self, base):
+        return os.path.join(self.path,
+                        '{:020d}{}'.format(base, SEGMENT_SUFFIX))
+
+class Journal(object):
+    """
+    Logs the messages of the channels it is subscribed to on a receiver,
+    like any subscription. A read-only journal reads what another process
+    logs in the same directory.
+    """
+    lag = 0 # messages are written as they are delivered
+
+    def __init__(self, directory, segment_bytes=64 << 20,
+                retention_bytes=1 << 30, retention_secs=86400, readonly=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.retention_bytes = retention_bytes
+        self.retention_secs = retention_secs
+        self.readonly = readonly
+        self.channels = {}
+
+    def deliver(self, message):
+        # Subscribers on the channel get the same message, with its offset
+        message.offset = self.channel(message.channel).append(message.raw,
+                                                                time.time())
+
+    def channel(self, channel):
+        journal = self.channels.get(channel)
+        if journal is None:
+            path = os.path.join(self.directory, urllib.quote(channel, safe=''))
+            if self.readonly and not os.path.isdir(path):
+                return None
+            journal = self.channels[channel] = ChannelJournal(path,
+                    self.segment_bytes, self.retention_bytes,
+                    self.retention_secs, self.readonly)
+        elif self.readonly:
+            journal.refresh()
+        return journal
+
+    def read(self, channel, offset=None, since=None):
+        """
+        Returns an iterator of (offset, payload) over the channel's messages
+        logged so far, starting from an offset (negative counts back from
+        the end), from the first message at or after a time, or else from
+        the start.
+        """
+        journal = self.channel(channel)
+        if journal is None:
+            return iter([])
+        end = journal.end
+        if since is not None:
+            offset = journal.offset_at(since)
+        elif offset is None:
+            offset = journal.start
+        elif offset < 0:
+            offset = max(0, end + offset)
+        return ((offset, payload)
+                    for offset, payload, _ in journal.read(offset, end))
+
+    def flush(self):
+        for journal in self.channels.values():
+            journal.flush()
+
+    def expire(self):
+        now = time.time()
+        for journal in self.channels.values():
+            if not journal.readonly:
+                journal.expire(now)
@@ -0,0 +1,108 @@
+"""
+Counters and latency histograms for the hub's hot paths. The hub only
+creates a Metrics when hub_metrics is enabled, and instrumented code skips
+everything when it has none, so disabled metrics cost a None check.
+"""
+import os
+import collections
+
+from ..util import monotonic
+
+# Each power of two of microseconds is split into this many buckets, so a
+# recorded latency is off by at most 1/16th
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+class Histogram(object):
+    """
+    Log-linear latency histogram in the style of HDR histograms. Buckets
+    are preallocated up to max_seconds, longer latencies land in the last.
+    Negative latencies, from clock skew between nodes, are recorded as 0
+    and counted in `negative`.
+    """
+    def __init__(self, max_seconds=60):
+        self.max_micros = int(max_seconds * 1000000)
+        self.counts = [0] * (self._index(self.max_micros) + 1)
+        self.total = 0
+        self.max = 0
+        self.negative = 0
+
+    @staticmethod
+    def _index(micros):
+        shift = max(0, micros.bit_length() - SUB_BUCKET_BITS - 1)
+        return shift * SUB_BUCKETS + (micros >> shift)
+
+    @staticmethod
+    def _value(index):
+        shift = max(0, index // SUB_BUCKETS - 1)
+        return (index - shift * SUB_BUCKETS) << shift
+
+    def record(self, seconds):
+        if seconds < 0:
+            self.negative += 1
+            seconds = 0
+        micros = min(int(seconds * 1000000), self.max_micros)
+        self.counts[self._index(micros)] += 1
+        self.total += 1
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, fraction):
+        """Returns the latency in seconds below which the fraction falls"""
+        if not self.total:
+            return 0
+        rank = max(1, int(self.total * fraction + 0.5))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(self._value(index), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self, points=(0.5, 0.9, 0.99, 0.999)):
+        summary = dict(('p{:g}'.format(point * 100),
+                    round(self.percentile(point) * 1000, 3)) for point in points)
+        summary['count'] = self.total
+        summary['negative'] = self.negative
+        summary['max'] = round(self.max / 1000.0, 3)
+        return summary
+
+class Metrics(object):
+    """
+    Counts everything but only times one in `sample` operations, since
+    reading the clock and recording costs about as much as a publish.
+    """
+    def __init__(self, sample=16):
+        self.sample = max(1, sample)
+        self.counters = collections.Counter()
+        self.histograms = collections.defaultdict(Histogram)
+        self.started = monotonic()
+        self._calls = 0
+
+    def count(self, name, amount=1):
+        self.counters[name] += amount
+
+    def record(self, name, seconds):
+        self.histograms[name].record(seconds)
+
+    def start(self):
+        """Returns a start time for one in every `sample` calls, else None"""
+        self._calls += 1
+        if not self._calls % self.sample:
+            return monotonic()
+
+    def stop(self, name, started):
+        if started is not None:
+            self.histograms[name].record(monotonic() - started)
+
+    def snapshot(self, **extra):
+        """Returns the counters and latency summaries in milliseconds"""
+        snapshot = {
+            'pid': os.getpid(),
+            'uptime_secs': round(monotonic() - self.started, 3),
+            'counters': dict(self.counters),
+            'latency_ms': dict((name, histogram.summary())
+                        for name, histogram in self.histograms.items()),
+        }
+        snapshot.update(extra)
+        return snapshot
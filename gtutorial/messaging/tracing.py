@@ -0,0 +1,66 @@
+"""
+Sampled end-to-end tracing of numbers on their way to subscribers. A trace
+is a list of [stage, node, time] stamps that travels with a message, in its
+own frame through the backend. Every stage appends its stamp and records
+the latency since the previous one, so percentiles are kept per pair of
+stages along with the total at the socket write. Stamps are wall clock
+times, so between nodes they are only as good as the clocks' sync.
+"""
+import time
+import collections
+
+from .metrics import Histogram
+
+class Traced(object):
+    """A value picked for tracing, along with its trace"""
+    __slots__ = ('value', 'trace')
+
+    def __init__(self, value, trace):
+        self.value = value
+        self.trace = trace
+
+    def __str__(self):
+        return str(self.value)
+
+    def __repr__(self):
+        return '<Traced {!r}>'.format(self.value)
+
+class Tracer(object):
+    def __init__(self, identity=None, sample=1000):
+        self.identity = identity
+        self.sample = max(1, sample)
+        self.stages = collections.defaultdict(Histogram)
+        self._calls = 0
+
+    def sampled(self):
+        """True for one in every `sample` calls"""
+        self._calls += 1
+        return not self._calls % self.sample
+
+    def begin(self, value, stage):
+        return Traced(value, [[stage, self.identity, time.time()]])
+
+    def record(self, trace, stage):
+        """Stamps a stage and records the latency since the previous one"""
+        now = time.time()
+        self._record(trace, stage, now)
+        trace.append([stage, self.identity, now])
+
+    def finish(self, trace, stage):
+        """
+        Records the last stage without stamping the trace, which is shared
+        by every subscriber the message is written to.
+        """
+        now = time.time()
+        self._record(trace, stage, now)
+        self.stages['total'].record(now - trace[0][2])
+
+    def _record(self, trace, stage, now):
+        previous = trace[-1]
+        self.stages['{}>{}'.format(previous[0], stage)].record(
+                                                    now - previous[2])
+
+    def summary(self):
+        """Latency percentiles in milliseconds per pair of stages"""
+        return dict((name, histogram.summary())
+                    for name, histogram in self.stages.items())
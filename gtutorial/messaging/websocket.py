@@ -1,29 +1,84 @@
-import gevent
+import json
 import logging
 
+import gevent
+
 from ginkgo.core import Service, autospawn
 from ginkgo import Setting
 
+from ws4py.framing import Frame, OPCODE_TEXT
 from ws4py.server.geventserver import WebSocketServer
 
 logger = logging.getLogger(__name__)
 
+def _text_frame(msg):
+    # Server frames are unmasked, so the same bytes suit every socket
+    return Frame(opcode=OPCODE_TEXT, body=str(msg), fin=1).build()
+
+def _json(msg):
+    return json.dumps(msg.value)
+
 class WebSocketStreamer(Service):
     port = Setting('websocket_port', default=7070)
+    coalesce = Setting('websocket_coalesce', default=False, help="""\
+        Send the messages queued for a socket as one JSON array frame
+        instead of one frame per message
+        """)
+    max_batch = Setting('websocket_max_batch', default=64,
+        help="Most queued messages written to a socket per wakeup")
 
     def __init__(self, hub):
         self.hub = hub
 
         self.add_service(
-            WebSocketServer((self.hub.bind_interface, self.port), self.handle))
+            WebSocketServer(self.hub.listener(self.port), self.handle,
+                            spawn=self.hub.admission.spawner(self.spawn)))
 
     def handle(self, websocket, environ):
+        """
+        Each time the socket's greenlet wakes up it drains everything queued
+        for it, up to max_batch messages, and writes them in a single send.
+        """
         channel = environ.get('PATH_INFO')
+        if not self.hub.admission.admit(channel):
+            websocket.close(1013, 'Too many subscribers')
+            return
         subscription = self.hub.subscribe(channel)
-        for msg in subscription:
-            try:
-                websocket.send(msg)
+        try:
+            for msg in subscription:
+                batch = [msg]
+                while len(batch) < self.max_batch and not subscription.empty():
+                    msg = subscription.get_nowait()
+                    if msg is StopIteration:
+                        break
+                    batch.append(msg)
+                self._write(websocket, batch)
+                if msg is StopIteration:
+                    # Cut off by the subscription's overflow policy
+                    websocket.close()
+                    break
                 gevent.sleep(0)
-            except IOError:
-                break
+        except IOError:
+            pass
+        finally:
+            subscription.cancel()
+            self.hub.admission.release(channel)
 
+    def _write(self, websocket, batch):
+        metrics = self.hub.metrics
+        if metrics is not None:
+            metrics.count('websocket_written', len(batch))
+            started = metrics.start()
+        if self.coalesce:
+            websocket.send('[{}]'.format(
+                ','.join([msg.render(_json) for msg in batch])))
+        else:
+            websocket.sock.sendall(
+                ''.join([msg.render(_text_frame) for msg in batch]))
+        if metrics is not None:
+            metrics.stop('websocket_write', started)
+        tracer = self.hub.tracer
+        if tracer is not None:
+            for msg in batch:
+                if msg.trace is not None:
+                    tracer.finish(msg.trace, 'write')
@@ -1,27 +1,82 @@
+import os
 import sys
 import random
+import struct
 import logging
 
 import gevent
+from gevent import Timeout
 from gevent.server import StreamServer
-from gevent.queue import Queue
+from gevent.queue import Queue, Full
 from gevent.socket import create_connection
 
 from ginkgo.core import Service, autospawn
 from ginkgo import Setting
 
+from .util import monotonic
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 logger = logging.getLogger(__name__)
 
+# A client sends this right after connecting to ask for binary frames, and
+# the server echoes it to agree. Binary frames are a 4 byte big endian
+# count followed by that many numbers, one byte each.
+BINARY_HELLO = 'binary\n'
+_COUNT = struct.Struct('!I')
+
+_LINES = ['{}\n'.format(number) for number in xrange(11)]
+# Maps random bytes onto 0-10. Bytes from 253 up are dropped, since
+# keeping them would make the low numbers more likely.
+_ELEVENS = ''.join(chr(byte % 11) for byte in xrange(256))
+_BIASED = ''.join(chr(byte) for byte in xrange(253, 256))
+
+def random_numbers(count):
+    """Returns count random numbers from 0 to 10 as a bytearray"""
+    if numpy is not None:
+        return bytearray(numpy.random.randint(0, 11, count)
+                                        .astype(numpy.uint8).tostring())
+    numbers = bytearray()
+    while len(numbers) < count:
+        numbers += bytearray(os.urandom(count - len(numbers))).translate(
+                                                    _ELEVENS, _BIASED)
+    return numbers
+
+def encode_lines(numbers):
+    return ''.join(map(_LINES.__getitem__, numbers))
+
+def encode_frame(numbers):
+    return _COUNT.pack(len(numbers)) + str(numbers)
+
 class NumberServer(Service):
     address = Setting("numbers_bind", default=('0.0.0.0', 7776))
     emit_rate = Setting("rate_per_minute", default=60)
+    high_rate = Setting("numbers_high_rate", default=False, help="""\
+        Generate numbers in blocks on one schedule and send the same block
+        to every client, for rates beyond a few thousand a second
+        """)
+    tick = Setting("numbers_tick_ms", default=10,
+        help="How often a block is sent in high rate mode")
+    client_blocks = Setting("numbers_client_blocks", default=64,
+        help="Blocks queued per client before blocks are dropped for it")
+    binary = Setting("numbers_binary", default=False, help="""\
+        Let clients ask for binary frames. Line clients then wait for the
+        hello timeout before their first number
+        """)
+    hello_timeout = Setting("numbers_hello_ms", default=200)
 
     def __init__(self):
+        self.clients = {}
         self.add_service(
                 StreamServer(self.address, self.handle))
 
     def do_start(self):
         logger.info("NumberServer is starting.")
+        if self.high_rate:
+            self._pace()
 
     def do_stop(self):
         logger.info("NumberServer is stopping.")
@@ -31,20 +86,99 @@ class NumberServer(Service):
 
     def handle(self, socket, address):
         logger.debug("New connection {}".format(address))
+        try:
+            encode = self._negotiate(socket)
+        except IOError:
+            logger.debug("Connection dropped {}".format(address))
+            return
+        if self.high_rate:
+            self._stream(socket, address, encode)
+            return
         while True:
             try:
                 number = random.randint(0, 10)
-                socket.send("{}\n".format(number))
+                socket.send(encode(bytearray([number])))
                 gevent.sleep(60.0/self.emit_rate)
             except IOError:
                 logger.debug("Connection dropped {}".format(address))
                 break
 
+    def _negotiate(self, socket):
+        """Returns the client's encoder, binary only if it asks right away"""
+        if not self.binary:
+            return encode_lines
+        hello = ''
+        with Timeout(self.hello_timeout / 1000.0, False):
+            while len(hello) < len(BINARY_HELLO) and \
+                                    BINARY_HELLO.startswith(hello):
+                data = socket.recv(len(BINARY_HELLO) - len(hello))
+                if not data:
+                    break
+                hello += data
+        if hello != BINARY_HELLO:
+            return encode_lines
+        socket.sendall(BINARY_HELLO)
+        return encode_frame
+
+    def _stream(self, socket, address, encode):
+        queue = Queue(maxsize=self.client_blocks)
+        self.clients[socket] = (queue, encode)
+        try:
+            for block in queue:
+                socket.sendall(block)
+        except IOError:
+            logger.debug("Connection dropped {}".format(address))
+        finally:
+            del self.clients[socket]
+
+    @autospawn
+    def _pace(self):
+        rate = self.emit_rate / 60.0
+        started = monotonic()
+        emitted = 0
+        while True:
+            gevent.sleep(self.tick / 1000.0)
+            due = int((monotonic() - started) * rate) - emitted
+            if not due:
+                continue
+            emitted += due
+            if not self.clients:
+                continue
+            numbers = random_numbers(due)
+            blocks = {}
+            for queue, encode in self.clients.values():
+                if encode not in blocks:
+                    blocks[encode] = encode(numbers)
+                try:
+                    queue.put_nowait(blocks[encode])
+                except Full:
+                    pass # this client is behind, it misses the block
+
 class NumberClient(Service):
-    def __init__(self, address=None):
+    """
+    Reads numbers in bulk into a reusable buffer and splits them a whole
+    read at a time. The queue is bounded: when it is full, reading stops
+    and the server is held back by TCP. Lost connections are retried
+    with exponential backoff.
+
+    Numbers are strings read from lines by default. A binary client asks
+    for binary frames and gets ints, falling back to lines if the server
+    doesn't agree. Given a tracer, the first number of a sampled read is
+    queued as a Traced number stamped with the read.
+    """
+    queue_size = Setting("numbers_queue_size", default=65536,
+        help="Numbers buffered before the client stops reading")
+    read_size = Setting("numbers_read_bytes", default=65536)
+    reconnect_delay = Setting("numbers_reconnect_secs", default=0.5)
+    max_reconnect_delay = Setting("numbers_max_reconnect_secs", default=30)
+
+    def __init__(self, address=None, binary=False, tracer=None):
         self.address = address
-        self.queue = Queue()
+        self.binary = binary
+        self.tracer = tracer
+        self.queue = Queue(maxsize=self.queue_size)
         self.socket = None
+        self.buffer = bytearray(self.read_size)
 
     def do_start(self):
         self.spawn(self._connect)
@@ -52,18 +186,74 @@ class NumberClient(Service):
     def _connect(self):
         if self.socket is not None:
             raise RuntimeError("Client is already connected")
-        self.socket = create_connection(self.address)
-        fileobj = self.socket.makefile()
+        delay = self.reconnect_delay
         while True:
             try:
-                number = fileobj.readline() # returns None on EOF
-                if number is not None:
-                    self.queue.put(number.strip())
+                self.socket = create_connection(self.address)
+                logger.info("Connected to numbers at {}".format(self.address))
+                delay = self.reconnect_delay
+                self._read()
+            except IOError as e:
+                logger.debug("Numbers connection failed: {}".format(e))
+            finally:
+                if self.socket is not None:
+                    self.socket.close()
+                    self.socket = None
+            gevent.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+    def _read(self):
+        view = memoryview(self.buffer)
+        pending = ''
+        binary = False
+        if self.binary:
+            self.socket.sendall(BINARY_HELLO)
+            binary = None # until the server answers
+        while True:
+            received = self.socket.recv_into(self.buffer)
+            if not received:
+                return
+            pending += view[:received].tobytes()
+            if binary is None:
+                if len(pending) < len(BINARY_HELLO) and \
+                                    BINARY_HELLO.startswith(pending):
+                    continue
+                binary = pending.startswith(BINARY_HELLO)
+                if binary:
+                    pending = pending[len(BINARY_HELLO):]
                 else:
-                    break
-            except IOError:
+                    logger.info("Numbers server declined binary frames")
+            traced = self.tracer is not None and self.tracer.sampled()
+            if binary:
+                pending = self._frames(pending, traced)
+            else:
+                pending = self._lines(pending, traced)
+
+    def _lines(self, data, traced=False):
+        """Queues the complete lines in data and returns the rest"""
+        lines = data.split('\n')
+        for line in lines[:-1]:
+            line = line.strip()
+            if line:
+                if traced:
+                    line, traced = self.tracer.begin(line, 'read'), False
+                self.queue.put(line)
+        return lines[-1]
+
+    def _frames(self, data, traced=False):
+        """Queues the complete binary frames in data and returns the rest"""
+        offset = 0
+        while len(data) - offset >= _COUNT.size:
+            count, = _COUNT.unpack_from(data, offset)
+            end = offset + _COUNT.size + count
+            if len(data) < end:
                 break
-        self.socket = None
+            for number in bytearray(data[offset + _COUNT.size:end]):
+                if traced:
+                    number, traced = self.tracer.begin(number, 'read'), False
+                self.queue.put(number)
+            offset = end
+        return data[offset:]
 
     def __iter__(self):
         return self
@@ -71,3 +261,10 @@ class NumberClient(Service):
     def next(self):
         return self.queue.get()
 
+    def next_batch(self, size=1024):
+        """Waits for a number, then returns up to size that are waiting"""
+        batch = [self.queue.get()]
+        get = self.queue.get_nowait
+        for _ in xrange(min(size - 1, self.queue.qsize())):
+            batch.append(get())
+        return batch
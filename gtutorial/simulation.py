@@ -0,0 +1,335 @@
+"""
+Deterministic in-process simulation of cluster coordination.
+
+Many coordinators run in one process and talk over an in-memory network
+instead of real ZMQ sockets. The network has configurable latency, loss
+and partitions, and all of them run on a virtual clock: time only moves
+forward once every greenlet is blocked, so a 100 node cluster can be
+simulated for minutes of cluster time in well under that.
+
+Coordinators that take a `zmq_` context can be simulated, which covers
+`cluster_.ClusterCoordinator` and `coordination.Leadership`. The virtual
+clock is patched into the modules given to `Simulation.patch`.
+"""
+import heapq
+import random
+import itertools
+import collections
+
+import gevent
+import gevent.event
+import gevent.queue
+from gevent_zeromq import zmq
+
+from . import cluster_
+from . import coordination
+from . import liveness
+
+SIMULATED_MODULES = (cluster_, coordination, liveness)
+
+class VirtualClock(object):
+    def __init__(self):
+        self._now = 0.0
+        self._timers = []
+        self._sequence = itertools.count()
+
+    def now(self):
+        return self._now
+
+    def time(self):
+        return self._now
+
+    def schedule(self, delay, callback, *args):
+        timer = [self._now + max(0, delay), next(self._sequence),
+                                                    callback, args]
+        heapq.heappush(self._timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def sleep(self, seconds=0):
+        if not seconds:
+            gevent.sleep(0)
+            return
+        wakeup = gevent.event.Event()
+        self.schedule(seconds, wakeup.set)
+        wakeup.wait()
+
+    def advance(self):
+        """Jumps to the next timer and fires everything due, False if idle"""
+        while self._timers and self._timers[0][2] is None:
+            heapq.heappop(self._timers)
+        if not self._timers:
+            return False
+        self._now = max(self._now, self._timers[0][0])
+        while self._timers and self._timers[0][0] <= self._now:
+            _, _, callback, args = heapq.heappop(self._timers)
+            if callback is not None:
+                callback(*args)
+        return True
+
+    def timeout_class(self):
+        """Returns a gevent.Timeout stand-in running on this clock"""
+        clock = self
+
+        class Timeout(BaseException):
+            def __init__(self, seconds=None, exception=None):
+                self.seconds = seconds
+                self.exception = exception
+                self._timer = None
+                self._greenlet = None
+
+            def start(self):
+                if self.seconds is not None:
+                    self._greenlet = gevent.getcurrent()
+                    self._timer = clock.schedule(self.seconds, self._expire)
+
+            def cancel(self):
+                if self._timer is not None:
+                    clock.cancel(self._timer)
+                    self._timer = None
+
+            def _expire(self):
+                def throw():
+                    # Skip it if the block was left while this was queued
+                    if self._timer is not None and not self._greenlet.dead:
+                        self._timer = None
+                        self._greenlet.throw(self)
+                gevent.get_hub().loop.run_callback(throw)
+
+            def __enter__(self):
+                self.start()
+                return self
+
+            def __exit__(self, type, value, traceback):
+                self.cancel()
+                if value is self and self.exception is False:
+                    return True
+
+        return Timeout
+
+class _Proxy(object):
+    """Module stand-in overriding a few attributes of the real module"""
+    def __init__(self, module, **overrides):
+        self._module = module
+        self.__dict__.update(overrides)
+
+    def __getattr__(self, name):
+        return getattr(self._module, name)
+
+class Network(object):
+    def __init__(self, clock, latency=0.001, jitter=0.0, loss=0.0, seed=0):
+        self.clock = clock
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.random = random.Random(seed)
+        self.endpoints = {}
+        self.sockets = []
+        self.partitions = set()
+        self.sent = collections.Counter()
+        self.bytes = collections.Counter()
+        self.dropped = collections.Counter()
+
+    def partition(self, *groups):
+        """Cuts every host in a group off from the hosts in other groups"""
+        for group in groups:
+            for other in groups:
+                if other is not group:
+                    for a in group:
+                        for b in other:
+                            self.partitions.add((a, b))
+
+    def isolate(self, host):
+        self.partitions.update((host, h) for h in self.hosts() if h != host)
+        self.partitions.update((h, host) for h in self.hosts() if h != host)
+
+    def heal(self):
+        self.partitions.clear()
+
+    def hosts(self):
+        return set(socket.host for socket in self.sockets)
+
+    def deliver(self, source, destination, frames):
+        self.sent[source.host] += 1
+        self.bytes[source.host] += sum(len(frame) for frame in frames)
+        if (source.host, destination.host) in self.partitions or \
+                                    self.random.random() < self.loss:
+            self.dropped[source.host] += 1
+            return
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        self.clock.schedule(delay, destination.receive, source, frames)
+
+class Socket(object):
+    """The subset of ZMQ socket behaviour the coordinators rely on"""
+    def __init__(self, network, host, kind):
+        self.network = network
+        self.host = host
+        self.kind = kind
+        self.bound = []
+        self.connected = []
+        self.filters = set()
+        self.inbox = gevent.queue.Queue()
+        self.requester = None
+        self.closed = False
+        self._next_peer = 0
+
+    def bind(self, address):
+        self.network.endpoints[address] = self
+        self.bound.append(address)
+
+    def connect(self, address):
+        self.connected.append(address)
+
+    def close(self):
+        self.closed = True
+        for address in self.bound:
+            if self.network.endpoints.get(address) is self:
+                del self.network.endpoints[address]
+
+    def setsockopt(self, option, value):
+        if option == zmq.SUBSCRIBE:
+            self.filters.add(value)
+        elif option == zmq.UNSUBSCRIBE:
+            self.filters.discard(value)
+
+    def send(self, data):
+        self.send_multipart([data])
+
+    def recv(self):
+        return self.recv_multipart()[0]
+
+    def send_multipart(self, frames):
+        frames = list(frames)
+        if self.kind == zmq.PUB:
+            for peer in self._peers():
+                if peer.kind == zmq.SUB:
+                    self.network.deliver(self, peer, frames)
+        elif self.kind in (zmq.PUSH, zmq.REQ):
+            peers = [p for p in self._connected_peers()]
+            if peers:
+                peer = peers[self._next_peer % len(peers)]
+                self._next_peer += 1
+                self.network.deliver(self, peer, frames)
+        elif self.kind == zmq.REP and self.requester is not None:
+            requester, self.requester = self.requester, None
+            self.network.deliver(self, requester, frames)
+
+    def recv_multipart(self):
+        source, frames = self.inbox.get()
+        if self.kind == zmq.REP:
+            self.requester = source
+        return frames
+
+    def receive(self, source, frames):
+        if self.closed:
+            return
+        if self.kind == zmq.SUB and not any(frames[0].startswith(f)
+                                                for f in self.filters):
+            return
+        self.inbox.put((source, frames))
+
+    def _connected_peers(self):
+        for address in self.connected:
+            peer = self.network.endpoints.get(address)
+            if peer is not None and not peer.closed:
+                yield peer
+
+    def _peers(self):
+        peers = list(self._connected_peers())
+        for address in self.bound:
+            for socket in self.network.sockets:
+                if address in socket.connected and not socket.closed:
+                    peers.append(socket)
+        return peers
+
+class Context(object):
+    """Stands in for a zmq.Context on one simulated host"""
+    def __init__(self, network, host):
+        self.network = network
+        self.host = host
+
+    def socket(self, kind):
+        socket = Socket(self.network, self.host, kind)
+        self.network.sockets.append(socket)
+        return socket
+
+class Simulation(object):
+    """
+    Runs coordinators on a virtual clock over an in-memory network. Use it
+    as a context manager so the clock is patched into the coordination
+    modules only while the simulation runs.
+    """
+    def __init__(self, latency=0.001, jitter=0.0, loss=0.0, seed=0):
+        self.clock = VirtualClock()
+        self.network = Network(self.clock, latency, jitter, loss, seed)
+        self.nodes = {}
+        self._patched = []
+
+    def __enter__(self):
+        self.patch(*SIMULATED_MODULES)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        for node in self.nodes.values():
+            node.kill()
+        self.unpatch()
+
+    def patch(self, *modules):
+        overrides = {
+            'gevent': _Proxy(gevent, sleep=self.clock.sleep),
+            'Timeout': self.clock.timeout_class(),
+            'monotonic': self.clock.now,
+            'time': _Proxy(__import__('time'), time=self.clock.time),
+        }
+        for module in modules:
+            for name, value in overrides.items():
+                if name in module.__dict__:
+                    self._patched.append((module, name, module.__dict__[name]))
+                    setattr(module, name, value)
+
+    def unpatch(self):
+        while self._patched:
+            module, name, value = self._patched.pop()
+            setattr(module, name, value)
+
+    def context(self, host):
+        return Context(self.network, host)
+
+    def start(self, host, service):
+        """Starts a node's service in its own greenlet"""
+        self.nodes[host] = gevent.spawn(service.start)
+        return service
+
+    def run(self, seconds):
+        """Runs the simulation for a span of virtual time"""
+        self.run_until(lambda: False, seconds)
+
+    def run_until(self, condition, timeout):
+        """
+        Runs until the condition holds, returning the virtual time it took,
+        or None if it didn't hold within the timeout.
+        """
+        started = self.clock.now()
+        deadline = started + timeout
+        while True:
+            self._settle()
+            if condition():
+                return self.clock.now() - started
+            if self.clock.now() >= deadline:
+                return None
+            if not self.clock.advance():
+                return None
+
+    def messages_per_node(self):
+        sent = self.network.sent
+        return float(sum(sent.values())) / max(1, len(sent))
+
+    def _settle(self):
+        """Lets every runnable greenlet run until all of them are blocked"""
+        if hasattr(gevent, 'idle'):
+            gevent.idle()
+        else:
+            for _ in xrange(100):
+                gevent.sleep(0)
@@ -0,0 +1,77 @@
+import math
+import logging
+
+import gevent
+
+from ginkgo.core import Service, autospawn
+from ginkgo import Setting
+
+from .util import monotonic
+
+logger = logging.getLogger(__name__)
+
+class Timer(object):
+    __slots__ = ('callback', 'args', 'rounds')
+
+    def __init__(self, callback, args, rounds):
+        self.callback = callback
+        self.args = args
+        self.rounds = rounds
+
+    def cancel(self):
+        self.callback = None
+        self.args = None
+
+class TimerWheel(Service):
+    """
+    Hashed timer wheel that runs any number of timers from one greenlet.
+    Scheduling and cancelling are O(1), and each tick only looks at the
+    timers hashed into the current slot. Timers fire with a precision of
+    one tick. Callbacks run on the wheel's greenlet and must not block.
+    """
+    resolution = Setting('timer_resolution_ms', default=100)
+    slots = 512
+
+    def __init__(self):
+        self._wheel = [[] for _ in xrange(self.slots)]
+        self._tick = 0
+        self._origin = monotonic()
+
+    def do_start(self):
+        self._origin = monotonic()
+        self._tick = 0
+        self._run()
+
+    def schedule(self, delay, callback, *args):
+        """Calls the callback after delay seconds, returns a cancelable Timer"""
+        ticks = max(1, int(math.ceil(delay * 1000.0 / self.resolution)))
+        timer = Timer(callback, args, (ticks - 1) // self.slots)
+        self._wheel[(self._tick + ticks) % self.slots].append(timer)
+        return timer
+
+    @autospawn
+    def _run(self):
+        while True:
+            gevent.sleep(self.resolution / 1000.0)
+            # Catch up on ticks missed while the hub was busy
+            target = int((monotonic() - self._origin) * 1000 / self.resolution)
+            while self._tick < target:
+                self._tick += 1
+                self._expire(self._tick % self.slots)
+
+    def _expire(self, slot):
+        due, pending = [], []
+        for timer in self._wheel[slot]:
+            if timer.callback is None:
+                continue
+            elif timer.rounds:
+                timer.rounds -= 1
+                pending.append(timer)
+            else:
+                due.append(timer)
+        self._wheel[slot] = pending
+        for timer in due:
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback failed")
@@ -1,3 +1,48 @@
+import os
+import sys
+import time
+import contextlib
+
+def _clock_gettime():
+    """
+    Returns a monotonic clock calling clock_gettime(CLOCK_MONOTONIC)
+    through ctypes, since Python 2 has none in the standard library
+    """
+    import ctypes
+    import ctypes.util
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    # Only in librt before glibc 2.17
+    library = ctypes.CDLL(ctypes.util.find_library('rt'), use_errno=True)
+    clock_gettime = library.clock_gettime
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+    CLOCK_MONOTONIC = 1
+    spec = timespec()
+    spec_ref = ctypes.byref(spec)
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, spec_ref):
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return spec.tv_sec + spec.tv_nsec * 1e-9
+    monotonic()
+    return monotonic
+
+try:
+    from time import monotonic
+except ImportError:
+    monotonic = None
+    if sys.platform.startswith('linux'):
+        try:
+            monotonic = _clock_gettime()
+        except (ImportError, OSError, AttributeError):
+            pass
+    if monotonic is None:
+        # Wall clock time, which jumps when the clock is set
+        monotonic = time.time
+
 class Observable(object):
     def __init__(self):
         self._observers = []
@@ -17,33 +62,101 @@ class Observable(object):
             if hasattr(observer, '__call__'):
                 observer(*args, **kwargs)
 
+class ElementObserver(object):
+    """
+    Adapts an observer that takes a single add= or remove= element to the
+    batched (added, removed) notifications of ObservableSet
+    """
+    def __init__(self, observer):
+        self.observer = observer
+
+    def __call__(self, added, removed):
+        for element in added:
+            self.observer(add=element)
+        for element in removed:
+            self.observer(remove=element)
+
+    def __eq__(self, other):
+        return self.observer == getattr(other, 'observer', other)
+
+    def __ne__(self, other):
+        return not self == other
+
 class ObservableSet(Observable):
+    """
+    Set that notifies observers of changes as (added, removed) sets. A
+    replace is a single notification, and changes made inside a batch()
+    block are merged into one notification when the block exits.
+    """
     def __init__(self, iterable=None):
         super(ObservableSet, self).__init__()
         self._set = set(iterable or [])
+        self._batching = 0
+        self._added = set()
+        self._removed = set()
+
+    def attach(self, observer):
+        """Attaches an observer called once per element as add= or remove="""
+        super(ObservableSet, self).attach(ElementObserver(observer))
+
+    def attach_changes(self, observer):
+        """Attaches an observer called as observer(added, removed)"""
+        super(ObservableSet, self).attach(observer)
 
     def add(self, element):
         if element not in self._set:
             self._set.add(element)
-            self.notify(add=element)
+            self._changed(set([element]), set())
 
     def remove(self, element):
         if element in self._set:
             self._set.remove(element)
-            self.notify(remove=element)
+            self._changed(set(), set([element]))
 
     def replace(self, new_set):
         added = new_set - self._set
         removed = self._set - new_set
-        self._set = new_set
+        self._set = set(new_set)
+        self._changed(added, removed)
+
+    @contextlib.contextmanager
+    def batch(self):
+        self._batching += 1
+        try:
+            yield self
+        finally:
+            self._batching -= 1
+            if not self._batching and (self._added or self._removed):
+                added, removed = self._added, self._removed
+                self._added, self._removed = set(), set()
+                self.notify(added, removed)
+
+    def _changed(self, added, removed):
+        if not self._batching:
+            if added or removed:
+                self.notify(added, removed)
+            return
+        # Changes that cancel out within the batch are not reported
         for element in added:
-            self.notify(add=element)
+            if element in self._removed:
+                self._removed.remove(element)
+            else:
+                self._added.add(element)
         for element in removed:
-            self.notify(remove=element)
+            if element in self._added:
+                self._added.remove(element)
+            else:
+                self._removed.add(element)
 
     def __iter__(self):
         return self._set.__iter__()
 
+    def __len__(self):
+        return len(self._set)
+
+    def __contains__(self, element):
+        return element in self._set
+
     def __repr__(self):
         return str(self._set)
 